@@ -0,0 +1,346 @@
+import os
+import sys
+import errno
+import fcntl
+import shutil
+import hashlib
+import json
+import optparse
+import tempfile
+
+
+def makedirs(path, mode=0777):
+    """Creates a directory and its parents, if they don't exist yet"""
+
+    try:
+        os.makedirs(path, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return path
+
+
+def cache_dir(*parts):
+    """Returns (and creates) a directory below the per-user InkTeX cache,
+    which lives in $XDG_CACHE_HOME/inktex or ~/.cache/inktex."""
+
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+
+    return makedirs(os.path.join(base, 'inktex', *parts))
+
+
+def runtime_dir(*parts):
+    """Returns (and creates) a private directory for runtime files such as
+    sockets. It lives in $XDG_RUNTIME_DIR if that is set, or in the system's
+    temporary directory otherwise."""
+
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base and os.access(base, os.W_OK):
+        base = os.path.join(base, 'inktex')
+    else:
+        base = os.path.join(tempfile.gettempdir(), 'inktex-%d' % os.getuid())
+
+    return makedirs(os.path.join(base, *parts), 0700)
+
+
+def scratch_dir():
+    """Returns the directory to create temporary working directories in.
+    RAM backed filesystems ($XDG_RUNTIME_DIR or /dev/shm) are preferred, so
+    intermediate files never hit the disk. Returns None, if neither is
+    available, i.e. the system's default temporary directory is used."""
+
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base and os.access(base, os.W_OK):
+        return runtime_dir('work')
+
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        path = makedirs('/dev/shm/inktex-%d' % os.getuid(), 0700)
+        # don't use a directory somebody else created for us
+        if os.stat(path).st_uid == os.getuid():
+            return path
+
+    return None
+
+
+def directory_entries(directory, skip=()):
+    """Returns a list of (mtime, size, path) tuples of all files below a
+    directory, except the ones named in skip, temporary files and lock
+    files"""
+
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            if name in skip or name.endswith(('.tmp', '.lock')):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def prune_directory(directory, max_size, skip=()):
+    """Removes the oldest files below a directory until their total size is
+    below max_size bytes. Returns the number of removed files."""
+
+    entries = sorted(directory_entries(directory, skip))
+    size = sum(e[1] for e in entries)
+    removed = 0
+
+    for mtime, entry_size, path in entries:
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        size -= entry_size
+        removed += 1
+
+    return removed
+
+
+def hash_key(*parts):
+    """Build a hex digest from an arbitrary number of strings"""
+
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        sha.update(str(len(part)))
+        sha.update(':')
+        sha.update(part)
+    return sha.hexdigest()
+
+
+class RenderCache(object):
+    """
+    A content addressed cache for rendered svg files. Entries are stored
+    as single files named after their key in the cache directory. Whenever
+    an entry is read, its modification time is updated, so the eviction of
+    the oldest files, once the cache grows larger than max_size bytes,
+    results in a LRU policy.
+
+    The hit/miss counters of the svg entries are kept in memory and added
+    to the persistent ones in the stats file by flush(), which also prunes
+    the cache. It is called once per batch of renders.
+    """
+
+    max_size = 50 * 1024 * 1024
+    stats_file = 'stats.json'
+    lock_file = 'stats.lock'
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or cache_dir('renders')
+        if max_size is not None:
+            self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        # the counters not written to the stats file yet
+        self.pending = {'hits': 0, 'misses': 0}
+        self.added = False
+
+    def path(self, key, suffix='.svg'):
+        """Returns the path of a cache entry"""
+
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix='.svg'):
+        """Returns the contents of a cache entry or None on a miss. Only the
+        lookups of svg entries are counted, the other suffixes are auxiliary
+        files of the same renders."""
+
+        path = self.path(key, suffix)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            if suffix == '.svg':
+                self.record(hit=False)
+            return None
+
+        if suffix == '.svg':
+            self.record(hit=True)
+        return data
+
+    def put(self, key, data, suffix='.svg'):
+        """Stores data in the cache. The data is written to a temporary file
+        first and moved in place, so concurrent readers never see half
+        written entries. Old entries are evicted by flush()."""
+
+        self.write(self.path(key, suffix), data)
+        self.added = True
+
+    def write(self, path, data):
+        """Atomically replace a file in the cache directory"""
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) tuples of all entries"""
+
+        return directory_entries(self.directory,
+                                 [self.stats_file, self.lock_file])
+
+    def prune(self, max_size=None):
+        """Removes the least recently used entries until the cache is
+        smaller than max_size bytes. Returns the number of removed files."""
+
+        if max_size is None:
+            max_size = self.max_size
+
+        return prune_directory(self.directory, max_size,
+                               [self.stats_file, self.lock_file])
+
+    def record(self, hit):
+        """Update the hit/miss counters of this instance"""
+
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.pending['hits' if hit else 'misses'] += 1
+
+    def flush(self):
+        """Prune the cache, if entries were added, and add the counters
+        recorded since the last call to the stats file. Concurrent updates
+        of the stats file are serialized by a lock file."""
+
+        if self.added:
+            self.added = False
+            self.prune()
+
+        if not any(self.pending.values()):
+            return
+
+        lock_path = os.path.join(self.directory, self.lock_file)
+        try:
+            with open(lock_path, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                stats = self.stats()
+                for name, count in self.pending.iteritems():
+                    stats[name] += count
+                self.write(os.path.join(self.directory, self.stats_file),
+                           json.dumps(stats))
+        except (IOError, OSError):
+            return
+
+        self.pending = {'hits': 0, 'misses': 0}
+
+    def stats(self):
+        """Returns the persistent hit/miss counters"""
+
+        stats = {'hits': 0, 'misses': 0}
+        try:
+            with open(os.path.join(self.directory, self.stats_file), 'r') as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+
+class FontCache(object):
+    """
+    The directory, in which dvisvgm caches the glyph outlines of the fonts
+    it has processed, so they are reused by later conversions. It is kept
+    below max_size bytes by removing the oldest files.
+    """
+
+    max_size = 20 * 1024 * 1024
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or cache_dir('fonts')
+        if max_size is not None:
+            self.max_size = max_size
+
+    def prune(self, max_size=None):
+        """Removes the oldest files until the cache is smaller than max_size
+        bytes. Returns the number of removed files."""
+
+        if max_size is None:
+            max_size = self.max_size
+
+        return prune_directory(self.directory, max_size)
+
+
+class FormatCache(object):
+    """
+    The directory with the precompiled formats, one for each preamble. A
+    format is touched whenever it is used, and the least recently used ones
+    are removed once the directory grows larger than max_size bytes.
+    """
+
+    max_size = 100 * 1024 * 1024
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or cache_dir('formats')
+        if max_size is not None:
+            self.max_size = max_size
+
+    def touch(self, name):
+        """Mark a format as used"""
+
+        try:
+            os.utime(os.path.join(self.directory, name), None)
+        except OSError:
+            pass
+
+    def prune(self, max_size=None):
+        """Removes the least recently used formats until the directory is
+        smaller than max_size bytes. Returns the number of removed files."""
+
+        if max_size is None:
+            max_size = self.max_size
+
+        return prune_directory(self.directory, max_size)
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [options]\n\n"
+              "Reports the size of InkTeX's caches and prunes them.")
+    parser.add_option("--prune", dest="prune", action="store_true",
+                      default=False,
+                      help="prune the render, format and font caches to "
+                           "their size limits")
+    parser.add_option("--clear", dest="clear", action="store_true",
+                      default=False, help="remove all cached files")
+    options, args = parser.parse_args()
+
+    renders = RenderCache()
+    formats = FormatCache()
+    fonts = FontCache()
+
+    if options.clear:
+        for name in ('renders', 'formats', 'fonts'):
+            shutil.rmtree(cache_dir(name), ignore_errors=True)
+            cache_dir(name)
+    elif options.prune:
+        removed = renders.prune() + formats.prune() + fonts.prune()
+        sys.stdout.write("Removed %d files\n" % removed)
+
+    for name in ('renders', 'formats', 'fonts'):
+        entries = directory_entries(cache_dir(name), [RenderCache.stats_file,
+                                                      RenderCache.lock_file])
+        sys.stdout.write("%-8s %6d files %10.1f KiB  %s\n" % (
+            name, len(entries), sum(e[1] for e in entries) / 1024.0,
+            cache_dir(name)))
+
+    stats = renders.stats()
+    sys.stdout.write("render cache: %d hits, %d misses\n" % (
+        stats['hits'], stats['misses']))
+
+
+if __name__ == "__main__":
+    main()
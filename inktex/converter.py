@@ -2,11 +2,20 @@ import tempfile
 import os
 import subprocess as sp
 import shutil
-import copy
 import re
+import signal
+import socket
+import fcntl
+import threading
+import time
 
 import inkex
 
+from cache import RenderCache, FontCache, FormatCache, scratch_dir, \
+    hash_key
+from toolchain import Toolchain
+from workspace import Workspace
+
 
 class CompilerException(Exception):
     """
@@ -26,38 +35,96 @@ class DependencyException(Exception):
     """
     pass
 
+class CancelledException(Exception):
+    """
+    Exception thrown, when the rendering was cancelled by the user
+    """
+    pass
+
+class TimeoutException(Exception):
+    """
+    Exception thrown, when the compiler/converter exceeded the timeout
+    """
+    pass
+
 class Converter(object):
     """
-    This class is responsible for creating a temporary folder, generating the
-    latex document, compiling it and converting it into svg.
-    The class should be used with a with statement, so temporary stuff can
-    be cleaned up:
+    This class is responsible for choosing a working folder, generating the
+    latex document, compiling it and converting it into svg. The working
+    folder is a persistent Workspace of the preamble, which is locked while
+    it is used.
+    The class should be used with a with statement, so the workspace is
+    released afterwards:
 
         with Converter() as conv:
             conv.run()
     """
 
-    skeleton = r"""\documentclass{article}
+    # the preview package crops every page to the box of its snippet and
+    # reports the height, depth and width of the box in the log
+    skeleton_preamble = r"""\documentclass{article}
+                \usepackage[active,tightpage]{preview}
+                \setlength\PreviewBorder{0pt}
+                %s
+                """
+
+    skeleton_document = r"""\begin{document}
                 %s
-                \begin{document}
-                \pagestyle{empty}
-                \noindent
-                    %s
                 \end{document}"""
 
+    # every snippet is typeset on a page of its own
+    skeleton_snippet = r"""\begin{preview}
+                    %s
+                \end{preview}"""
+
+    skeleton = skeleton_preamble + skeleton_document + skeleton_snippet
+
+    # appended to the preamble to dump a precompiled format
+    format_dump = r"""
+                \dump"""
+
     tex_file = 'inktex.tex'
     pdf_file = 'inktex.pdf'
     dvi_file = 'inktex.dvi'
     svg_file = 'inktex.svg'
+    png_file = 'inktex.png'
 
     namespaces = dict(inkex.NSS.items() + {
         u'inktex': u'http://www.oelerich.org/inktex'
     }.items())
 
+    # the entries of a fingerprint, see get_fingerprint()
+    fingerprint_names = ('preamble', 'toolchain', 'minify')
+
+    # attributes with the size of the snippet's box in user units. The
+    # baseline is height units below the top of the rendered group.
+    metrics = ('height', 'depth', 'width')
+
     compiler_pdf = 'pdflatex %s' % tex_file
     converter_pdf = 'pdf2svg %s %s' % (pdf_file, svg_file)
     compiler_dvi = 'latex %s' % tex_file
-    converter_dvi = 'dvisvgm -n %s' % dvi_file
+    # dvisvgm writes the svg to its standard output
+    converter_dvi = 'dvisvgm -n --bbox=preview -s %s' % dvi_file
+
+    # converter commands writing one svg file per page
+    converter_pdf_pages = 'pdf2svg %s inktex-%%d.svg all' % pdf_file
+    converter_dvi_pages = 'dvisvgm -n --bbox=preview -p1- -o inktex-%%p.svg ' \
+        '%s' % dvi_file
+    page_re = re.compile(r'^inktex-(\d+)\.svg$')
+
+    # the size of a snippet's box in scaled points, as reported by preview
+    metrics_re = re.compile(
+        r'Preview: Snippet (\d+) ended\.\((-?\d+)\+(-?\d+)x(-?\d+)\)')
+    # scaled points per svg user unit (big point)
+    sp_per_bp = 65536 * 72.27 / 72
+
+    # references to other elements in attribute values
+    url_re = re.compile(r'url\(\s*(#[^)\s]*)\s*\)')
+
+    # raster preview of the dvi file, the resolution is appended
+    previewer_dvi = 'dvipng -q -T tight -bg Transparent -o %s %s' % \
+        (png_file, dvi_file)
+    preview_dpi = 96
 
     def add_ns(tag, ns=None):
         """Adds the namespace to an object"""
@@ -70,159 +137,756 @@ class Converter(object):
             return tag
     add_ns = staticmethod(add_ns)
 
-    def __init__(self, effect_class):
+    def __init__(self, effect_class, output_callback=None):
         # find out which compiler/converter we'll use
-        devnull = open(os.devnull, 'w')
-
         self.effect_class = effect_class
+        self.output_callback = output_callback
+        self.process = None
+        self.connection = None
+        self.timeout = None
+        self.timed_out = False
+        self.dump_time = 0
+        self.cancelled = False
         self.compiler = None
         self.converter = None
-
-        # try svg executables
-        try:
-            sp.call(self.compiler_dvi.split(" "),
-                            stdout=devnull, stderr=devnull)
-            sp.call(self.converter_dvi.split(" "),
-                            stdout=devnull, stderr=devnull)
-
+        self.previewer = None
+        self.cache = RenderCache()
+        self.format_cache = FormatCache()
+        self.font_cache = None
+        self.toolchain = Toolchain()
+
+        self.pipeline = pipeline = self.toolchain.get_pipeline()
+        if pipeline == 'dvi':
             self.compiler = self.compiler_dvi.split(" ")
             self.converter = self.converter_dvi.split(" ")
-
-            return
-        except:
-            pass
-
-        # try pdf executables
-        try:
-            sp.call(self.compiler_pdf.split(" "),
-                            stdout=devnull, stderr=devnull)
-            sp.call(self.converter_pdf.split(" "),
-                            stdout=devnull, stderr=devnull)
-
+            self.converter_pages = self.converter_dvi_pages.split(" ")
+            self.converter_stdout = True
+            self.commands = (self.compiler_dvi, self.converter_dvi)
+        elif pipeline == 'pdf':
             self.compiler = self.compiler_pdf.split(" ")
             self.converter = self.converter_pdf.split(" ")
-
-            return
-        except:
-            pass
-
-        raise DependencyException()
+            self.converter_pages = self.converter_pdf_pages.split(" ")
+            self.converter_stdout = False
+            self.commands = (self.compiler_pdf, self.converter_pdf)
+        else:
+            raise DependencyException()
+
+        # use the full paths of the discovered executables
+        self.compiler_name = self.compiler[0]
+        self.converter_name = self.converter[0]
+        self.compiler[0] = self.toolchain.get_path(self.compiler_name)
+        self.converter[0] = self.toolchain.get_path(self.converter_name)
+        self.converter_pages[0] = self.converter[0]
+
+        # let dvisvgm keep the processed fonts in a persistent cache
+        if pipeline == 'dvi':
+            self.font_cache = FontCache()
+            option = '--cache=%s' % self.font_cache.directory
+            self.converter.insert(1, option)
+            self.converter_pages.insert(1, option)
+
+        # dvipng is optional and only useful with the dvi pipeline
+        if pipeline == 'dvi' and self.toolchain.has_tool('dvipng'):
+            self.previewer = self.previewer_dvi.split(" ")
+            self.previewer[0] = self.toolchain.get_path('dvipng')
 
     def __enter__(self):
-        """Create temporary directory for the convertion"""
+        """The working directory is chosen, once the preamble is known"""
 
-        self.tmp_dir = tempfile.mkdtemp()
+        self.workspace = None
+        self.tmp_dir = None
         return self
 
     def __exit__(self, type, value, traceback):
-        """Clean up temporary files"""
+        """Release the working directory and write the cache statistics"""
+
+        self.leave_workspace()
+        self.cache.flush()
 
-        shutil.rmtree(self.tmp_dir)
+    def enter_workspace(self, preamble_code):
+        """Use the persistent working directory of the preamble, so the .aux
+        file and other state of earlier runs with it is kept. If no
+        workspace can be locked, a temporary directory is used instead."""
 
-    def render(self, src, settings):
-        """Executes some functions in order"""
+        name = hash_key(self.pipeline, preamble_code)[:16]
+        if self.workspace is not None and self.workspace.name == name:
+            return
+
+        self.leave_workspace()
+        self.workspace = Workspace(name)
+        self.tmp_dir = self.workspace.acquire()
+
+        if self.tmp_dir is None:
+            self.workspace = None
+            self.tmp_dir = tempfile.mkdtemp(dir=scratch_dir())
+
+    def leave_workspace(self):
+        """Unlock the workspace or remove the temporary directory"""
+
+        if self.workspace is not None:
+            self.workspace.release()
+        elif self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+        self.workspace = None
+        self.tmp_dir = None
+
+    def remove_outputs(self):
+        """Remove the output files of earlier runs from the working
+        directory, so they are never mistaken for the ones of the current
+        run"""
+
+        outputs = (self.pdf_file, self.dvi_file, self.svg_file, self.png_file)
+        for name in os.listdir(self.tmp_dir):
+            if name in outputs or self.page_re.match(name):
+                os.remove(os.path.join(self.tmp_dir, name))
+
+    def render(self, src, settings, glyphs=None):
+        """Executes some functions in order and returns the svg group"""
+
+        return self.get_svg_group(self.produce(src, settings),
+                                  self.get_scale(settings), glyphs,
+                                  self.get_minifier(settings))
+
+    def produce(self, src, settings):
+        """Returns the svg file contents for a snippet. If the same source
+        was rendered with the same preamble and toolchain before, the svg is
+        taken from the render cache and latex is not run at all. This does
+        not touch the document, so it may run in a worker thread."""
+
+        preamble_code = self.get_preamble(settings)
+        self.timeout = self.get_timeout(settings)
+        self.enter_workspace(preamble_code)
+
+        key = self.cache_key(src, preamble_code)
+        svg = self.cache.get(key)
+
+        if svg is None:
+            if self.restore_dvi(key):
+                # the preview compiled this snippet already
+                svg = self.add_metrics(self.convert(),
+                                       self.cache.get(key, '.metrics'))
+            else:
+                fmt = self.get_format(preamble_code)
+                svg = self.render_daemon(src, preamble_code, fmt)
+
+                if svg is None:
+                    self.write_latex([src], preamble_code, fmt)
+                    log = self.compile(fmt)
+                    svg = self.add_metrics(self.convert(),
+                                           self.get_metrics(log).get(1))
+
+            self.cache.put(key, svg)
+
+        return svg
+
+    def preview(self, src, settings, dpi=None):
+        """Returns an image of a snippet for display in the dialog. If the
+        dvi pipeline is used and dvipng is installed, this is a png rendered
+        at the given resolution, which is a lot faster than converting to svg.
+        The dvi file is kept in the render cache, so that the svg conversion
+        on apply doesn't compile the snippet again. Otherwise, the svg is
+        returned."""
+
+        if not self.previewer:
+            return self.produce(src, settings)
+
+        preamble_code = self.get_preamble(settings)
+        self.timeout = self.get_timeout(settings)
+        self.enter_workspace(preamble_code)
+
+        key = self.cache_key(src, preamble_code)
+        dpi = int(round(dpi or self.preview_dpi))
+        png_key = '%s-%d' % (key, dpi)
+
+        png = self.cache.get(png_key, '.png')
+        if png is None:
+            if not self.restore_dvi(key):
+                fmt = self.get_format(preamble_code)
+                self.write_latex([src], preamble_code, fmt)
+                log = self.compile(fmt)
+                self.cache.put(key, self.read_file(self.dvi_file), '.dvi')
+                self.cache.put(key, self.get_metrics(log).get(1, ''),
+                               '.metrics')
+
+            self.execute(self.previewer[:1] + ['-D', str(dpi)] +
+                         self.previewer[1:], ConverterException)
+            png = self.read_file(self.png_file)
+            self.cache.put(png_key, png, '.png')
+
+        return png
+
+    def restore_dvi(self, key):
+        """Copies the cached dvi file of a snippet to the temporary directory.
+        Returns False, if there is none."""
+
+        if self.pipeline != 'dvi':
+            return False
+
+        dvi = self.cache.get(key, '.dvi')
+        if dvi is None:
+            return False
+
+        with open(os.path.join(self.tmp_dir, self.dvi_file), 'wb') as f:
+            f.write(dvi)
+        return True
+
+    def render_many(self, srcs, settings, glyphs=None):
+        """Renders a list of LaTeX snippets and returns a list with one svg
+        group per snippet. All snippets missing from the render cache are
+        typeset as separate pages of a single document, which is compiled
+        and converted only once. Empty snippets yield None."""
+
+        preamble_code = self.get_preamble(settings)
+        self.timeout = self.get_timeout(settings)
+        self.enter_workspace(preamble_code)
+
+        keys = [self.cache_key(src, preamble_code) for src in srcs]
+        svgs = [None] * len(srcs)
+        missing = []
+
+        for i, src in enumerate(srcs):
+            if not src.strip():
+                continue
+            svgs[i] = self.cache.get(keys[i])
+            if svgs[i] is None:
+                missing.append(i)
+
+        if missing:
+            fmt = self.get_format(preamble_code)
+            self.write_latex([srcs[i] for i in missing], preamble_code, fmt)
+            metrics = self.get_metrics(self.compile(fmt))
+            pages = self.convert_pages()
+
+            if len(pages) != len(missing):
+                raise ConverterException(
+                    "Expected %d pages, but got %d. Every snippet must "
+                    "produce exactly one page." % (len(missing), len(pages)))
+
+            for page, (i, svg) in enumerate(zip(missing, pages)):
+                svgs[i] = self.add_metrics(svg, metrics.get(page + 1))
+                self.cache.put(keys[i], svgs[i])
+
+        scale_factor = self.get_scale(settings)
+        minifier = self.get_minifier(settings)
+        return [self.get_svg_group(svg, scale_factor, glyphs, minifier)
+                if svg else None for svg in svgs]
+
+    def get_preamble(self, settings):
+        """Returns the contents of the preamble file"""
 
-        # find preamble code
         preamble_code = ""
         if 'preamble' in settings and os.path.exists(settings['preamble']):
             with open(settings['preamble'], "r") as preamble_file:
                 preamble_code = preamble_file.read()
+        return preamble_code
+
+    def get_scale(self, settings):
+        """Returns the scale factor"""
 
         scale_factor = 1.0
         if 'scale' in settings:
-            scale_factor = settings['scale']
-
-        self.write_latex(src, preamble_code)
-        self.compile()
-        self.convert()
-        return self.get_svg_group(scale_factor)
+            scale_factor = float(settings['scale'])
+        return scale_factor
+
+    def get_minifier(self, settings):
+        """Returns a Minifier, if the output should be minified, or None"""
+
+        if str(settings.get('minify', False)) != 'True':
+            return None
+
+        # numpy, used by the minifier, takes long to import
+        from minify import Minifier
+        return Minifier(int(float(settings.get('precision', 3))))
+
+    def get_timeout(self, settings):
+        """Returns the timeout for each compiler/converter run in seconds or
+        None, if there is none."""
+
+        if float(settings.get('timeout', 0)) > 0:
+            return float(settings['timeout'])
+        return None
+
+    def cache_key(self, tex_code, preamble_code):
+        """Returns the render cache key of a LaTeX snippet. It covers
+        everything that influences the generated svg. It is stored with the
+        objects as well, so it only covers the commands as written above,
+        not the paths of the executables or the font cache, which differ
+        between users and machines."""
+
+        return hash_key(tex_code, preamble_code, self.skeleton,
+                        " ".join(self.commands),
+                        self.toolchain.get_version(self.compiler_name),
+                        self.toolchain.get_version(self.converter_name))
+
+    def get_fingerprint(self, settings):
+        """Returns a dict describing what an object rendered with the given
+        settings depends on, apart from its source: a hash of the preamble,
+        the versions of the compiler and converter and, if the object is
+        minified, the precision. It is stored with the objects to tell which
+        of them are outdated."""
+
+        fingerprint = {
+            'preamble': hash_key(self.get_preamble(settings))[:16],
+            'toolchain': '; '.join([
+                self.toolchain.get_version(self.compiler_name) or
+                self.compiler_name,
+                self.toolchain.get_version(self.converter_name) or
+                self.converter_name,
+            ]),
+        }
+
+        minifier = self.get_minifier(settings)
+        if minifier is not None:
+            fingerprint['minify'] = str(minifier.precision)
+
+        return fingerprint
+
+    def get_format(self, preamble_code):
+        """Returns the name of a precompiled format containing the document
+        class and the preamble. The format is dumped on first use and kept
+        in the user cache. If dumping fails, None is returned and the
+        document is compiled the normal way. Only a preamble latex rejects
+        is never tried again, other failures are retried next time. The
+        time spent on dumping is taken from the timeout of the run that
+        follows."""
+
+        name = 'inktex-' + hash_key(
+            self.skeleton_preamble, preamble_code, " ".join(self.compiler),
+            self.toolchain.get_version(self.compiler_name))[:16]
+
+        fmt_dir = self.format_cache.directory
+        if os.path.exists(os.path.join(fmt_dir, name + '.fmt')):
+            self.format_cache.touch(name + '.fmt')
+            return name
+        if os.path.exists(os.path.join(fmt_dir, name + '.failed')):
+            return None
+
+        # render threads and other Inkscape instances missing the same
+        # format wait for the one dumping it
+        lock = open(os.path.join(fmt_dir, name + '.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if os.path.exists(os.path.join(fmt_dir, name + '.fmt')):
+                return name
+            if os.path.exists(os.path.join(fmt_dir, name + '.failed')):
+                return None
+
+            start = time.time()
+            try:
+                self.dump_format(name, preamble_code)
+            except CompilerException:
+                open(os.path.join(fmt_dir, name + '.failed'), 'w').close()
+                return None
+            except (TimeoutException, IOError, OSError):
+                return None
+            finally:
+                self.dump_time = time.time() - start
+        finally:
+            lock.close()
+
+        self.format_cache.prune()
+        return name
+
+    def dump_format(self, name, preamble_code):
+        """Run latex in ini mode on the preamble and move the resulting
+        format file to the format cache. The partial output of a failed
+        dump is removed."""
+
+        fmt_dir = self.format_cache.directory
+        dumped = os.path.join(self.tmp_dir, name + '.fmt')
+        tmp_file = None
 
-    def write_latex(self, tex_code, preamble_code):
+        try:
+            f = open(os.path.join(self.tmp_dir, name + '.tex'), 'w')
+            f.write(self.skeleton_preamble % preamble_code + self.format_dump)
+            f.close()
+
+            self.execute(
+                [self.compiler[0], '-ini', '-interaction=nonstopmode',
+                 '-jobname=%s' % name, '&%s' % self.compiler_name,
+                 name + '.tex'],
+                CompilerException, stream=False
+            )
+
+            # copy next to the final location first, so the rename is atomic
+            fd, tmp_file = tempfile.mkstemp(dir=fmt_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f, open(dumped, 'rb') as fmt:
+                shutil.copyfileobj(fmt, f)
+            os.rename(tmp_file, os.path.join(fmt_dir, name + '.fmt'))
+            tmp_file = None
+        finally:
+            for path in (dumped, tmp_file):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+
+    def get_latex(self, tex_codes, preamble_code, fmt=None):
+        """Returns the latex document with one page per snippet. If a
+        precompiled format is used, the preamble is already contained in
+        it."""
+
+        document = self.skeleton_document % "\n".join(
+            self.skeleton_snippet % tex_code for tex_code in tex_codes)
+
+        if not fmt:
+            document = self.skeleton_preamble % preamble_code + document
+        return document
+
+    def write_latex(self, tex_codes, preamble_code, fmt=None):
         """Generate the latex file"""
 
+        self.remove_outputs()
+
         f = open(os.path.join(self.tmp_dir, self.tex_file), 'w')
-        f.write(self.skeleton % (preamble_code, tex_code))
+        f.write(self.get_latex(tex_codes, preamble_code, fmt))
         f.close()
 
-    def compile(self):
-        """compile the latex file. Raise CompilerException on errors"""
+    def get_compiler(self, fmt=None):
+        """Returns the compiler command and the additional environment
+        variables needed to load the format"""
+
+        if not fmt:
+            return self.compiler, {}
+
+        # a trailing separator keeps the default search path
+        return self.compiler[:1] + ['-fmt=%s' % fmt] + self.compiler[1:], \
+            {'TEXFORMATS': self.format_cache.directory + os.pathsep}
+
+    def render_daemon(self, tex_code, preamble_code, fmt=None):
+        """Let the render daemon typeset the snippet with a latex process
+        that has already loaded the preamble. Returns the svg file contents
+        or None, if the daemon is not running."""
+
+        # the daemon's latex reads everything up to the line containing
+        # the snippet in advance
+        marker = '\0'
+        document = self.get_latex([marker], preamble_code, fmt)
+        split = document.rfind('\n', 0, document.index(marker)) + 1
+
+        command, env = self.get_compiler(fmt)
+        jobname = os.path.splitext(self.tex_file)[0]
+
+        # only needed for snippets, which are not cached yet
+        import daemon
+
+        if self.cancelled:
+            raise CancelledException("Rendering cancelled")
+
+        dump_time = self.dump_time
+        timeout = self.get_run_timeout()
+        response = daemon.request(timeout=timeout,
+                                  connected=self.connect_daemon, message={
+            'compiler': command[:-1] + ['-jobname=%s' % jobname,
+                                        '-interaction=scrollmode'],
+            'env': env,
+            'head': document[:split],
+            'body': document[split:].replace(marker, tex_code),
+            'converter': self.converter,
+            'svg_file': None if self.converter_stdout else self.svg_file,
+            'timeout': timeout,
+        })
+        self.connection = None
+
+        if self.cancelled:
+            raise CancelledException("Rendering cancelled")
+        if response is None or response['status'] == 'cancelled':
+            # the daemon is not running or quit while rendering. The
+            # compilation that follows is the run after the dump.
+            self.dump_time = dump_time
+            return None
+        if response['status'] == 'timeout':
+            raise TimeoutException("Timeout of %g seconds exceeded"
+                                   % self.timeout)
+        if response['status'] == 'compiler':
+            raise CompilerException(response['log'])
+        if response['status'] != 'ok':
+            raise ConverterException(response['log'])
+
+        self.prune_font_cache()
+        return self.add_metrics(response['svg'].encode('utf-8'),
+                                self.get_metrics(response.get('log')).get(1))
+
+    def connect_daemon(self, connection):
+        """Called with the connection to the daemon, which is closed to
+        cancel the render"""
+
+        self.connection = connection
+        if self.cancelled:
+            self.kill()
+
+    def compile(self, fmt=None):
+        """compile the latex file and return its output. Raise
+        CompilerException on errors"""
+
+        command, env = self.get_compiler(fmt)
+        if env:
+            env = dict(os.environ, **env)
+        else:
+            env = None
 
-        proc = sp.Popen(
-            self.compiler, cwd=self.tmp_dir,
-            stdout=sp.PIPE, stderr=sp.PIPE,
-            stdin=sp.PIPE
-        )
+        try:
+            return self.execute(command, CompilerException, env)
+        except Exception:
+            # the .aux file of a failed run may break the next ones
+            aux_file = os.path.splitext(self.tex_file)[0] + '.aux'
+            if os.path.exists(os.path.join(self.tmp_dir, aux_file)):
+                os.remove(os.path.join(self.tmp_dir, aux_file))
+            raise
+
+    def get_metrics(self, log):
+        """Returns the height, depth and width of the snippets' boxes, as
+        reported by the preview package in the latex output. The result
+        maps the number of each snippet to its metrics in svg user units,
+        formatted as the value of an attribute."""
+
+        metrics = dict()
+        for m in self.metrics_re.finditer(log or ''):
+            metrics[int(m.group(1))] = ' '.join(
+                '%.3f' % (int(v) / self.sp_per_bp) for v in m.groups()[1:])
+        return metrics
+
+    def add_metrics(self, svg, metrics):
+        """Adds the metrics of a snippet to the root element of its svg, so
+        they are kept in the render cache along with it"""
+
+        if not metrics:
+            return svg
+
+        # the svg is a byte string with an encoding declaration, which lxml
+        # only parses as long as it is not turned into unicode
+        attributes = ' xmlns:inktex="%s"' % str(self.namespaces[u'inktex'])
+        for name, value in zip(self.metrics, str(metrics).split()):
+            attributes += ' inktex:%s="%s"' % (name, value)
+
+        return re.sub(r'<svg\b', lambda m: '<svg' + attributes, svg, count=1)
 
-        out, err = proc.communicate()
+    def convert(self):
+        """Convert the generated file to svg and return the svg file contents.
+        If the converter supports it, the svg is read from its standard
+        output instead of a file. Raise ConverterException on errors"""
 
-        if proc.returncode:
-            raise CompilerException(out)
+        try:
+            if self.converter_stdout:
+                return self.execute(self.converter, ConverterException,
+                                    capture=True)
 
-    def convert(self):
-        """Convert the generated file to svg. Raise ConverterException on err"""
+            self.execute(self.converter, ConverterException)
+            return self.read_svg()
+        finally:
+            self.prune_font_cache()
+
+    def convert_pages(self):
+        """Convert all pages of the generated file to svg and return the
+        contents of the svg files ordered by page number."""
+
+        try:
+            self.execute(self.converter_pages, ConverterException)
+        finally:
+            self.prune_font_cache()
+
+        pages = []
+        for name in os.listdir(self.tmp_dir):
+            m = self.page_re.match(name)
+            if m:
+                with open(os.path.join(self.tmp_dir, name), 'rb') as f:
+                    pages.append((int(m.group(1)), f.read()))
+
+        return [svg for page, svg in sorted(pages)]
+
+    def prune_font_cache(self):
+        """Keep the font cache of the converter below its size limit"""
+
+        if self.font_cache is not None:
+            self.font_cache.prune()
 
-        # check, which path we are going to take.
+    def execute(self, command, exception, env=None, stream=True,
+                capture=False):
+        """Run a command in the temporary directory and return its output.
+        If stream is set, the output is passed to the output callback line
+        by line, as it arrives. If capture is set, the standard output is
+        returned as is, and only the standard error is treated as messages.
+        The process is started in a new process
+        group, so it can be killed along with its children when the render
+        is cancelled or the timeout is exceeded. Raise exception on errors."""
 
+        if self.cancelled:
+            raise CancelledException("Rendering cancelled")
+
+        timeout = self.get_run_timeout()
 
         proc = sp.Popen(
-            self.converter, cwd=self.tmp_dir,
-            stdout=sp.PIPE, stderr=sp.PIPE,
-            stdin=sp.PIPE
+            command, cwd=self.tmp_dir, env=env,
+            stdout=sp.PIPE, stderr=sp.PIPE if capture else sp.STDOUT,
+            stdin=sp.PIPE, preexec_fn=os.setsid
         )
+        proc.stdin.close()
+
+        # the captured output is read in a separate thread, so neither of
+        # the pipes can fill up
+        data = []
+        reader = None
+        messages = proc.stdout
+        if capture:
+            messages = proc.stderr
+            reader = threading.Thread(
+                target=lambda: data.append(proc.stdout.read()))
+            reader.start()
+
+        self.process = proc
+        self.timed_out = False
+        if self.cancelled:
+            self.kill()
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self.kill, [True])
+            timer.start()
+
+        out = []
+        try:
+            for line in iter(messages.readline, ''):
+                out.append(line)
+                if stream and self.output_callback:
+                    self.output_callback(line)
+            if reader:
+                reader.join()
+            proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            self.process = None
+
+        out = ''.join(out)
+
+        if self.cancelled:
+            raise CancelledException("Rendering cancelled")
+        if self.timed_out:
+            raise TimeoutException("Timeout of %g seconds exceeded\n\n%s"
+                                   % (self.timeout, out))
+        if proc.returncode:
+            raise exception(out)
+
+        if capture:
+            return data[0]
+        return out
+
+    def get_run_timeout(self):
+        """Returns the timeout of the next compiler/converter run. A format
+        dumped for the render counts towards the timeout of the run after
+        it."""
+
+        timeout = self.timeout
+        if timeout and self.dump_time:
+            timeout = max(timeout - self.dump_time, 0.01)
+        self.dump_time = 0
+        return timeout
+
+    def kill(self, timeout=False):
+        """Kill the running process and its children, or let the daemon kill
+        its process by closing the connection"""
+
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        proc = self.process
+        if proc is None or proc.poll() is not None:
+            return
 
-        out, err = proc.communicate()
+        if timeout:
+            self.timed_out = True
 
-        if proc.returncode:
-            raise ConverterException(out)
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def cancel(self):
+        """Cancel the rendering. This may be called from another thread."""
+
+        self.cancelled = True
+        self.kill()
+
+    def read_svg(self):
+        """Returns the contents of the generated svg file"""
 
+        return self.read_file(self.svg_file)
 
-    def get_svg_group(self, scale=1.0):
+    def read_file(self, name):
+        """Returns the contents of a file in the temporary directory"""
+
+        with open(os.path.join(self.tmp_dir, name), 'rb') as f:
+            return f.read()
+
+    def get_svg_group(self, svg, scale=1.0, glyphs=None, minifier=None):
         """this function parses the generated svg and returns a single
         svg group with all its contents. The ids of the elements are
-        made unique so we don't run into problems in inkscape later."""
+        made unique so we don't run into problems in inkscape later.
+        If a Minifier is given, the group is minified and the scale factor
+        may be baked into its coordinates. If a GlyphLibrary is given, the
+        glyph definitions are moved there."""
 
-        tree = inkex.etree.parse(os.path.join(self.tmp_dir, self.svg_file))
-        root = tree.getroot()
+        root = inkex.etree.fromstring(svg)
 
         self.scramble_ids(root)
 
-        master_group = inkex.etree.SubElement(root, 'g')
-        for c in root:
-            if c is not master_group:
-                master_group.append(c)
+        # the children are moved, not copied, into the new group
+        master_group = inkex.etree.Element('g')
+        for c in list(root):
+            master_group.append(c)
+
+        for name in self.metrics:
+            value = root.get(Converter.add_ns(name, ns=u'inktex'))
+            if value is not None:
+                master_group.attrib[Converter.add_ns(name, ns=u'inktex')] = \
+                    value
 
         # apply scaling
         if scale != 1.0:
             master_group.attrib['transform'] = 'scale(%f,%f)' % (scale, scale)
 
-        return copy.copy(master_group)
+        if minifier is not None and minifier.minify(master_group):
+            master_group.attrib[Converter.add_ns('baked', ns=u'inktex')] = \
+                repr(scale)
+
+        if glyphs is not None:
+            glyphs.intern(master_group)
+
+        return master_group
 
     def scramble_ids(self, root):
         """Here, we assign new ids to the elements in the newly generated
-        svg object. We also have to update references and links."""
+        svg object. We also have to update references and links, i.e.
+        xlink:href attributes and url(#...) references in any attribute, such
+        as clip-path, mask or style. The tree is walked only once; the
+        references are remembered and rewritten, once all ids are mapped."""
 
         href_map = dict()
-        ns = self.namespaces
         xlink_key = Converter.add_ns('href', ns=u'xlink')
-        clip_path_key = 'clip_path'
-
-        # Map items to new ids
-        for i, el in enumerate(root.xpath('//*[attribute::id]')):
-            cur_id = el.attrib['id']
-            new_id = self.effect_class.uniqueId(cur_id)
-            href_map['#' + cur_id] = "#" + new_id
-            el.attrib['id'] = new_id
-
-        # Replace hrefs
-        url_re = re.compile('^url\((.*)\)$')
-
-        for el in root.xpath('//*[attribute::xlink:href]', namespaces=ns):
-            cur_href = el.attrib[xlink_key]
-            el.attrib[xlink_key] = href_map.get(cur_href, cur_href)
-
-        for el in root.xpath('//*[attribute::svg:clip-path]', namespaces=ns):
-            m = url_re.match(el.attrib['clip-path'])
-            if m:
-                el.attrib[clip_path_key] = 'url(%s)' % href_map.get(
-                    m.group(1), m.group(1)
-                )
+        references = []
+
+        for el in root.iter():
+            if not isinstance(el.tag, basestring):
+                # comments and processing instructions
+                continue
+
+            for key, value in el.attrib.items():
+                if key == 'id':
+                    new_id = self.effect_class.unique_id(value)
+                    href_map['#' + value] = '#' + new_id
+                    el.attrib['id'] = new_id
+                elif key == xlink_key or 'url(' in value:
+                    references.append((el, key, value))
+
+        def replace_url(m):
+            return 'url(%s)' % href_map.get(m.group(1), m.group(1))
+
+        for el, key, value in references:
+            if key == xlink_key:
+                el.attrib[key] = href_map.get(value, value)
+            else:
+                el.attrib[key] = self.url_re.sub(replace_url, value)
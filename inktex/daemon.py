@@ -0,0 +1,435 @@
+#!/usr/bin/env python2
+
+"""
+An optional, long running render daemon for InkTeX.
+
+Inkscape starts a new python process for each invocation of the extension,
+so LaTeX has to load the document class and the preamble for every single
+formula. The daemon keeps latex processes around, which have already loaded
+the preamble and wait on their standard input for the snippet to typeset.
+The Converter talks to the daemon over a unix domain socket, if it is
+running, and falls back to starting latex itself otherwise.
+
+Start it with
+
+    python daemon.py [--socket PATH] [--idle-timeout SECONDS]
+
+It exits after being idle for the given time (default: one hour).
+
+Requests are handled in separate threads. A request is cancelled by closing
+the connection, which kills its latex process.
+"""
+
+import os
+import json
+import signal
+import socket
+import shutil
+import tempfile
+import optparse
+import threading
+import subprocess as sp
+import SocketServer
+
+from cache import runtime_dir, hash_key
+
+
+def socket_path():
+    """Returns the default path of the daemon's socket"""
+
+    return os.path.join(runtime_dir(), 'daemon.sock')
+
+
+def request(message, path=None, timeout=None, connected=None):
+    """Sends a render request to the daemon and returns its response. If no
+    daemon is running, None is returned. If the response doesn't arrive in
+    time, the status of the response is 'timeout'. connected is called with
+    the socket once it is connected. Shutting it down from another thread
+    cancels the request, the status of the response is 'cancelled' then."""
+
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return None
+
+        if connected is not None:
+            connected(sock)
+
+        # the connection stays open in both directions, the daemon takes
+        # its end as the cancellation of the request
+        sock.settimeout(timeout)
+        sock.sendall(json.dumps(message) + '\n')
+
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.timeout:
+        return {'status': 'timeout'}
+    except socket.error:
+        return {'status': 'cancelled'}
+    finally:
+        sock.close()
+
+    try:
+        return json.loads(''.join(chunks))
+    except ValueError:
+        return None
+
+
+class WarmCompiler(object):
+    """
+    A latex process in its own temporary directory, that has read the
+    beginning of the document (i.e., the preamble and \\begin{document}) from
+    its standard input and waits for the rest.
+    """
+
+    def __init__(self, compiler, head, env=None):
+        self.tmp_dir = tempfile.mkdtemp(dir=runtime_dir())
+
+        # the terminal output goes to a file, so a long preamble can't
+        # fill up a pipe nobody reads while we are waiting
+        self.terminal = open(os.path.join(self.tmp_dir, 'terminal.log'), 'w+')
+
+        environment = dict(os.environ)
+        environment.update(env or {})
+
+        # the processes get their own process groups, so they can be killed
+        # along with their children
+        self.proc = sp.Popen(
+            compiler, cwd=self.tmp_dir, env=environment,
+            stdout=self.terminal, stderr=sp.STDOUT,
+            stdin=sp.PIPE, preexec_fn=os.setsid
+        )
+        self.proc.stdin.write(head)
+        self.proc.stdin.flush()
+
+        self.converter = None
+        self.killed = False
+        self.timed_out = False
+
+    def finish(self, body, timeout=None):
+        """Send the rest of the document and wait for latex to finish.
+        Returns the exit code and the terminal output. The exit code is None,
+        if latex was killed, e.g. because it took longer than timeout
+        seconds."""
+
+        try:
+            self.proc.stdin.write(body + '\n')
+            self.proc.stdin.close()
+        except IOError:
+            # latex died while loading the preamble, the log tells why
+            pass
+
+        self.wait(self.proc, timeout)
+        self.terminal.seek(0)
+        if self.killed:
+            return None, self.terminal.read()
+        return self.proc.returncode, self.terminal.read()
+
+    def convert(self, converter, timeout=None):
+        """Run the converter in the temporary directory. Returns the exit
+        code, the standard output and the standard error. The exit code is
+        None, if the converter was killed."""
+
+        self.converter = sp.Popen(
+            converter, cwd=self.tmp_dir,
+            stdout=sp.PIPE, stderr=sp.PIPE,
+            stdin=sp.PIPE, preexec_fn=os.setsid
+        )
+        if self.killed:
+            self.kill()
+
+        out, err = self.wait(self.converter, timeout)
+        if self.killed:
+            return None, out, err
+        return self.converter.returncode, out, err
+
+    def wait(self, proc, timeout=None):
+        """Wait for a process and return its output. It is killed after
+        timeout seconds."""
+
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self.kill, [True])
+            # cancelled timers end right away, they need not be daemons like
+            # the request threads starting them
+            timer.daemon = False
+            timer.start()
+        try:
+            return proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def kill(self, timeout=False):
+        """Kill the running latex or converter process. This may be called
+        from another thread."""
+
+        if timeout:
+            self.timed_out = True
+        self.killed = True
+        for proc in (self.proc, self.converter):
+            if proc is None or proc.poll() is not None:
+                continue
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def read(self, name):
+        """Returns the contents of a file in the temporary directory"""
+
+        with open(os.path.join(self.tmp_dir, name), 'rb') as f:
+            return f.read()
+
+    def close(self):
+        """Kill latex, if it still runs, and remove the temporary files"""
+
+        if self.proc.poll() is None:
+            self.kill()
+            self.proc.wait()
+        self.terminal.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Reads a json request and writes the json response. If the client
+    closes the connection before, the render is cancelled."""
+
+    def handle(self):
+        self.warm = None
+        self.cancelled = False
+        try:
+            message = json.loads(self.rfile.readline())
+
+            watcher = threading.Thread(target=self.watch)
+            watcher.daemon = True
+            watcher.start()
+
+            response = self.server.render(message, self.started)
+        except Exception, e:
+            response = {'status': 'error', 'log': str(e)}
+        self.warm = None
+
+        if not self.cancelled:
+            self.wfile.write(json.dumps(response))
+
+    def started(self, warm):
+        """Called by the server with the latex process used for the
+        request"""
+
+        self.warm = warm
+        if self.cancelled:
+            warm.kill()
+
+    def watch(self):
+        """Wait for the client to close the connection, and kill latex if
+        it is still needed then"""
+
+        try:
+            while self.connection.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+        self.cancelled = True
+        warm = self.warm
+        if warm is not None:
+            warm.kill()
+
+
+class RenderDaemon(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    """
+    The daemon. It keeps one warm latex process for each of the most
+    recently used combinations of compiler command and preamble. After a
+    warm process was used, a new one is started right away, so it has loaded
+    the preamble by the time the next request arrives. Every request is
+    handled in its own thread, so concurrent renders don't wait for each
+    other.
+    """
+
+    pool_size = 4
+    daemon_threads = True
+    # seconds to wait for the running requests when quitting
+    shutdown_timeout = 5
+
+    def __init__(self, path, idle_timeout=3600):
+        # remove the socket of a daemon that is not running anymore
+        if os.path.exists(path) and request({}, path) is None:
+            os.remove(path)
+
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+        os.chmod(path, 0600)
+
+        self.path = path
+        self.timeout = idle_timeout
+        self.warm = []
+        # the warm processes used by running requests
+        self.busy = []
+        self.lock = threading.Lock()
+        # notified, when the last running request finished
+        self.idle = threading.Condition(self.lock)
+        self.active = 0
+        self.running = False
+
+    def process_request_thread(self, request, client_address):
+        """Counts the running requests"""
+
+        with self.lock:
+            self.active += 1
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.lock:
+                self.active -= 1
+                if not self.active:
+                    self.idle.notify_all()
+
+    def handle_timeout(self):
+        """No request for idle_timeout seconds: quit, unless a render is
+        still running"""
+
+        with self.lock:
+            if not self.active:
+                self.running = False
+
+    def serve(self):
+        """Handle requests until the daemon was idle for too long or is
+        terminated, then remove the latex processes, their temporary
+        directories and the socket"""
+
+        self.running = True
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            # the running requests fail once their processes are killed
+            with self.lock:
+                self.running = False
+                for warm in [warm for key, warm in self.warm] + self.busy:
+                    warm.kill()
+                if self.active:
+                    self.idle.wait(self.shutdown_timeout)
+                for warm in [warm for key, warm in self.warm] + self.busy:
+                    warm.close()
+            self.server_close()
+            os.remove(self.path)
+
+    def render(self, message, started=None):
+        """Typeset a snippet using a warm latex process and convert it. The
+        process is passed to started, so it can be killed when the request
+        is cancelled."""
+
+        if not message:
+            return {'status': 'ok'}
+
+        key = hash_key(json.dumps(message['compiler']), message['head'],
+                       json.dumps(message.get('env')))
+
+        warm = self.take(key)
+        if warm is None:
+            warm = WarmCompiler(message['compiler'], message['head'],
+                                message.get('env'))
+        with self.lock:
+            self.busy.append(warm)
+        if started is not None:
+            started(warm)
+
+        timeout = message.get('timeout')
+        try:
+            code, log = warm.finish(message['body'], timeout)
+            if code is None:
+                return self.killed_response(warm, log)
+            if code:
+                return {'status': 'compiler', 'log': log}
+
+            code, out, err = warm.convert(message['converter'], timeout)
+            if code is None:
+                return self.killed_response(warm, out + err)
+            if code:
+                return {'status': 'converter', 'log': out + err}
+
+            # without a file name, the converter writes to standard output
+            if message['svg_file']:
+                svg = warm.read(message['svg_file'])
+            else:
+                svg = out
+            return {'status': 'ok', 'svg': svg.decode('utf-8'), 'log': log}
+        finally:
+            with self.lock:
+                self.busy.remove(warm)
+            warm.close()
+            self.prepare(key, message)
+
+    def killed_response(self, warm, log):
+        """Returns the response for a render, whose process was killed
+        because of the timeout or because the daemon quits"""
+
+        if warm.timed_out:
+            return {'status': 'timeout', 'log': log}
+        return {'status': 'cancelled', 'log': log}
+
+    def take(self, key):
+        """Remove the warm process for key from the pool and return it"""
+
+        with self.lock:
+            for i, (warm_key, warm) in enumerate(self.warm):
+                if warm_key == key:
+                    del self.warm[i]
+                    return warm
+        return None
+
+    def prepare(self, key, message):
+        """Start a warm process for the next request with the same preamble
+        and drop the least recently used ones."""
+
+        if not self.running:
+            return
+
+        warm = WarmCompiler(message['compiler'], message['head'],
+                            message.get('env'))
+
+        with self.lock:
+            self.warm.append((key, warm))
+            dropped = self.warm[:-self.pool_size]
+            del self.warm[:-self.pool_size]
+
+        for old_key, old in dropped:
+            old.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--socket", dest="socket", default=socket_path(),
+                      help="path of the unix domain socket")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type="float",
+                      default=3600,
+                      help="quit after this many seconds without requests")
+    options, args = parser.parse_args()
+
+    daemon = RenderDaemon(options.socket, options.idle_timeout)
+
+    # kill quits like an interrupt, so serve() cleans up
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
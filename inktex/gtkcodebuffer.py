@@ -22,12 +22,16 @@
 
 
 import gtk
+import gobject
 import pango
 import re
 import sys
+import time
 import os.path
 import xml.sax
 import imp
+import cPickle
+import tempfile
 from xml.sax.handler import ContentHandler
 from xml.sax.saxutils import unescape
 
@@ -78,6 +82,18 @@ SYNTAX_PATH = [ os.path.join('.', 'syntax'),
                 os.path.join(sys.prefix,"share","pygtkcodebuffer","syntax")]
          
 
+# the compiled syntax-definitions are stored beside the syntax-files or, if
+#   that directory is not writable, here
+SYNTAX_CACHE_PATH = os.path.join(os.path.expanduser('~'), ".pygtkcodebuffer")
+
+# changes if the pickled rules of older versions can not be used anymore
+_CACHE_VERSION = 1
+
+
+# lexer-state of lines, which were not lexed yet
+_UNKNOWN = object()
+
+
 # enable/disable debug-messages
 DEBUG_FLAG  = False
 
@@ -85,11 +101,12 @@ DEBUG_FLAG  = False
 #
 # Some log functions...
 #   (internal used)
-def _log_debug(msg):
+def _log_debug(msg, *args):
+    # the message is only formatted if it is printed
     if not DEBUG_FLAG:
         return
     sys.stderr.write("DEBUG: ")
-    sys.stderr.write(msg)
+    sys.stderr.write(args and msg%args or msg)
     sys.stderr.write("\n")
     
 def _log_warn(msg):
@@ -105,6 +122,31 @@ def _log_error(msg):
 
 
 
+def _is_anchored(regexp):
+    """ Internal used function. Returns True if the regexp may match 
+        differently at the start of a string than in its middle, i.e. if it
+        contains anchors, word-boundaries or look-behinds. """
+    if set(re.findall(r'\\(.)', regexp)) & set('AbB'): return True
+    stripped = re.sub(r'\\.', '', regexp).replace('[^', '[')
+    return '^' in stripped or '(?<' in stripped
+
+
+def _literal(regexp):
+    """ Internal used function. Returns the string matched by regexp if it
+        matches exactly one string (i.e. only contains escaped or plain 
+        characters), None otherwise. """
+    chars = []; i = 0
+    while i < len(regexp):
+        char = regexp[i]
+        if char == '\\':
+            if i+1 == len(regexp) or regexp[i+1].isalnum(): return None
+            char = regexp[i+1]; i += 1
+        elif char in ".^$*+?{}[]|()":
+            return None
+        chars.append(char); i += 1
+    return "".join(chars)
+
+
 def add_syntax_path(path_or_list):
     """ This function adds one (string) or many (list of strings) paths to the 
         global search-paths for syntax-files. """
@@ -122,7 +164,39 @@ def add_syntax_path(path_or_list):
         
         
         
-class Pattern:
+class _Rule:
+    """ Internal used base-class of the rules. The regular expressions are 
+        compiled by _compile() but not pickled with the rule. An unpickled 
+        rule compiles them again on first use. """
+        
+    def _compile(self, name, regexp, flags=0):
+        """ Compiles regexp and stores it as attribute name. """
+        if not '_regexps' in self.__dict__: self._regexps = dict()
+        self._regexps[name] = (regexp, flags)
+        
+        try: setattr(self, name, re.compile(regexp, flags))
+        except re.error, e: 
+            raise Exception("Invalid regexp \"%s\": %s"%(regexp,str(e)))
+        
+        
+    def __getattr__(self, name):
+        regexps = self.__dict__.get('_regexps', {})
+        if not name in regexps: raise AttributeError(name)
+        
+        regexp = re.compile(*regexps[name])
+        setattr(self, name, regexp)
+        return regexp
+        
+        
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in self.__dict__.get('_regexps', {}): 
+            state.pop(name, None)
+        return state
+        
+        
+        
+class Pattern(_Rule):
     """ More or less internal used class representing a pattern. You may use 
         this class to "hard-code" your syntax-definition. """
 
@@ -142,7 +216,7 @@ class Pattern:
         # assemble re-flag
         flags += "ML"; flag   = 0
         
-        _log_debug("init rule %s -> %s (%s)"%(regexp, style, flags))
+        _log_debug("init rule %s -> %s (%s)", regexp, style, flags)
         
         for char in flags:
             if char == 'M': flag |= re.M
@@ -153,23 +227,35 @@ class Pattern:
             if char == 'X': flag |= re.X
 
         # compile re        
-        try: self._regexp = re.compile(regexp, flag)
-        except re.error, e: 
-            raise Exception("Invalid regexp \"%s\": %s"%(regexp,str(e)))
+        self._compile('_regexp', regexp, flag)
 
+        self._flags  = flag
         self._group  = group
+        self._anchored = _is_anchored(regexp)
         self.tag_name = style
         
         
-    def __call__(self, txt, start, end):
-        m = self._regexp.search(txt)
-        if not m: return None
+    def find(self, txt, pos, last=None):
+        """ Returns the offsets (start, end, anchor) of the first match in 
+            txt[pos:] (as if txt started at pos), where anchor is the offset at
+            which the match begins (start may belong to a group). If nothing 
+            matches, all three are len(txt). 
+            
+            last is the result of this method for a smaller pos. It is 
+            returned if it is still valid for pos, so every rule searches the
+            text only once per update. """
+        if last and not self._anchored and last[2] >= pos:
+            return last
+    
+        # anchored expressions may match differently at pos -> slice 
+        if self._anchored: m = self._regexp.search(txt[pos:]); offset = pos
+        else: m = self._regexp.search(txt, pos); offset = 0
         
-        mstart, mend = m.start(self._group), m.end(self._group)
-        s = start.copy(); s.forward_chars(mstart)
-        e = start.copy(); e.forward_chars(mend)
+        if not m or m.start(self._group) < 0: 
+            return (len(txt),)*3
         
-        return (s,e)    
+        return (offset+m.start(self._group), offset+m.end(self._group), 
+                offset+m.start(0))
     
 
 
@@ -190,9 +276,65 @@ class KeywordList(Pattern):
         regexp = "(?:\W|^)(%s)\W"%("|".join(keywords),)
         Pattern.__init__(self, regexp, style, group=1, flags=flags)
         
+        # keywords are regexps -> use a hash-table if all are plain strings
+        self._ignore_case = 'I' in flags
+        self._keywords = None
+        literals = map(_literal, keywords)
+        if keywords and not None in literals:
+            if self._ignore_case: literals = [l.lower() for l in literals]
+            self._keywords = dict()
+            for index, keyword in enumerate(literals):
+                self._keywords.setdefault(keyword, index)
+            self._lengths = sorted(set(map(len, literals)))
+            first = set(l[0] for l in literals)
+            self._compile('_first', "[%s]"%"".join(map(re.escape, first)), 
+                          self._flags)
+            self._compile('_nonword', r"\W", self._flags)
+        
+        
+    def find(self, txt, pos, last=None):
+        """ Like Pattern.find() but looks up the keywords in a hash-table. 
+            Like the regexp, it prefers a keyword preceded by a non-word 
+            character over one at the start of the text and takes the first
+            keyword of the list followed by a non-word character. """
+        if self._keywords is None: 
+            return Pattern.find(self, txt, pos, last)
+        
+        # pos is the start of the text -> check it first
+        if self._nonword.match(txt, pos):
+            end = self._keyword_end(txt, pos+1)
+            if end: return (pos+1, end, pos)
+        end = self._keyword_end(txt, pos)
+        if end: return (pos, end, pos)
+        
+        if last and last[2] > pos:
+            return last
+        
+        for m in self._first.finditer(txt, pos+1):
+            if self._nonword.match(txt, m.start()-1):
+                end = self._keyword_end(txt, m.start())
+                if end: return (m.start(), end, m.start()-1)
         
+        return (len(txt),)*3
         
-class String:
+        
+    def _keyword_end(self, txt, pos):
+        """ Returns the end-offset of the first keyword of the list at pos 
+            followed by a non-word character or None. """
+        best = None
+        for length in self._lengths:
+            if pos+length >= len(txt): break
+            word = txt[pos:pos+length]
+            if self._ignore_case: word = word.lower()
+            index = self._keywords.get(word)
+            if index is None or (best and best[0] < index): continue
+            if self._nonword.match(txt, pos+length):
+                best = (index, pos+length)
+        return best and best[1]
+        
+        
+        
+class String(_Rule):
     """ This class may be used to hard-code a syntax-definition. It simplifies 
         the definition of a "string". A "string" is something that consists of
         a start-pattern and an end-pattern. The end-pattern may be content of 
@@ -207,10 +349,9 @@ class String:
             
             The optional kwarg style specifies the style used to highlight the
             string. """
-        try:
-            self._starts  = re.compile(starts)
-        except re.error, e: 
-            raise Exception("Invalid regexp \"%s\": %s"%(regexp,str(e)))
+        self._anchored = _is_anchored(starts) or _is_anchored(ends)
+        
+        self._compile('_starts', starts)
         
         if escape:
             end_exp = "[^%(esc)s](?:%(esc)s%(esc)s)*%(end)s"
@@ -218,27 +359,32 @@ class String:
         else:
             end_exp = ends
 
-        try:     
-            self._ends    = re.compile(end_exp)
-        except re.error, e: 
-            raise Exception("Invalid regexp \"%s\": %s"%(regexp,str(e)))
+        self._compile('_ends', end_exp)
 
         self.tag_name = style
 
 
-    def __call__(self, txt, start, end):
-        start_match = self._starts.search(txt)
-        if not start_match: return
+    def find(self, txt, pos, last=None):
+        """ See Pattern.find(). If the end-pattern is not found, the string 
+            ends at the end of txt. """
+        if last and not self._anchored and last[2] >= pos:
+            return last
         
-        start_it = start.copy()
-        start_it.forward_chars(start_match.start(0))
-        end_it   = end.copy()
+        offset = 0
+        if self._anchored: 
+            txt = txt[pos:]; offset = pos; pos = 0
+            
+        start_match = self._starts.search(txt, pos)
+        if not start_match: 
+            return (offset+len(txt),)*3
         
-        end_match = self._ends.search(txt, start_match.end(0)-1)
+        end = len(txt)
+        end_match = self._ends.search(txt, max(start_match.end(0)-1, pos))
         if end_match:
-            end_it.set_offset(start.get_offset()+end_match.end(0))            
+            end = end_match.end(0)
             
-        return  start_it, end_it
+        return (offset+start_match.start(0), offset+end, 
+                offset+start_match.start(0))
 
 
         
@@ -255,31 +401,48 @@ class LanguageDefinition:
                 
                 
     def __call__(self, buf, start, end=None):
+        """ Returns the iters (start, end, style) of the first token in the 
+            buffer between start and end. style is None if there is none. """
         # if no end given -> end of buffer
         if not end: end = buf.get_end_iter()
-    
-        mstart = mend = end
-        mtag   = None
-        txt = buf.get_slice(start, end)    
         
-        # search min match
-        for rule in self._grammar:
-            # search pattern
-            m = rule(txt, start, end)            
-            if not m: continue
+        txt = buf.get_slice(start, end).decode('utf-8')
+        mstart, mend, mtag = self.scan(txt).next()
+        
+        s = start.copy(); s.forward_chars(mstart)
+        e = start.copy(); e.forward_chars(mend)
+        return (s, e, mtag)
+        
+        
+    def scan(self, txt):
+        """ Generator yielding the offsets (start, end, style) of the tokens 
+            in txt, one after another. The first match of any rule wins, the
+            longest one if several rules match at the same offset. After the 
+            last token (start, end, None) is yielded with start == end == 
+            len(txt). 
             
-            # prefer match with smallest start-iter 
-            if m[0].compare(mstart) < 0:
-                mstart, mend = m
-                mtag = rule.tag_name
-                continue
+            The text is scanned in a single forward pass: Each rule remembers 
+            its next match and only searches again once a token passed it. """
+        size = len(txt)
+        last = [None]*len(self._grammar)
+        pos  = 0
+        
+        while True:
+            mstart = mend = size
+            mtag   = None
             
-            if m[0].compare(mstart)==0 and m[1].compare(mend)>0:
-                mstart, mend = m
-                mtag = rule.tag_name
-                continue
-
-        return (mstart, mend, mtag)                
+            # search min match
+            for i, rule in enumerate(self._grammar):
+                m = last[i] = rule.find(txt, pos, last[i])
+                
+                # prefer match with smallest start, then the longest 
+                if m[0] < mstart or (m[0] == mstart and m[1] > mend):
+                    mstart, mend, mtag = m[0], m[1], rule.tag_name
+                    
+            yield (mstart, mend, mtag)
+            
+            if not mtag: return
+            pos = mend
 
 
     def get_styles(self):
@@ -336,13 +499,65 @@ class SyntaxLoader(ContentHandler, LanguageDefinition):
             fname = os.path.join(syntax_dir, "%s.xml"%lang_name)
             if os.path.isfile(fname): break
 
-        _log_debug("Loading syntaxfile %s"%fname)
-        
         if not os.path.isfile(fname):
             raise Exception("No snytax-file for %s found!"%lang_name)
             
+        # the compiled rules are valid as long as the file is unchanged
+        stat = os.stat(fname)
+        key  = (_CACHE_VERSION, __version__, os.path.abspath(fname), 
+                stat.st_mtime, stat.st_size)
+        cache_names = [fname+".cache", 
+                       os.path.join(SYNTAX_CACHE_PATH, "%s.cache"%lang_name)]
+        
+        for cache_name in cache_names:
+            table = self._load_cache(cache_name, key)
+            if table: 
+                _log_debug("Loaded compiled syntaxfile %s", cache_name)
+                self._grammar, self._styles = table
+                return
+
+        _log_debug("Loading syntaxfile %s", fname)
         xml.sax.parse(fname, self)
         
+        for cache_name in cache_names:
+            if self._save_cache(cache_name, key): break
+        
+        
+    def _load_cache(self, cache_name, key):
+        """ Internal used method. Returns the rules and styles stored in the 
+            cache-file if it belongs to key, None otherwise. """
+        try:
+            with open(cache_name, 'rb') as f:
+                if cPickle.load(f) != key: return None
+                return cPickle.load(f)
+        except Exception:
+            # missing, outdated or broken -> parse the syntax-file
+            return None
+            
+            
+    def _save_cache(self, cache_name, key):
+        """ Internal used method. Writes the rules and styles to the 
+            cache-file. Returns False if that failed. """
+        directory = os.path.dirname(cache_name)
+        try:
+            if not os.path.isdir(directory): os.makedirs(directory)
+            fd, tmp_name = tempfile.mkstemp(dir=directory)
+        except (IOError, OSError):
+            return False
+            
+        try:
+            # write to a temporary file first, so nobody reads half of it
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump((self._grammar, self._styles), f, 
+                             cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_name, cache_name)
+        except Exception, e:
+            _log_warn("Can not write %s: %s"%(cache_name, e))
+            os.remove(tmp_name)
+            return False
+        return True
+        
         
     # Dispatch start/end - document/element and chars        
     def startDocument(self):
@@ -508,6 +723,14 @@ class CodeBuffer(gtk.TextBuffer):
     """ This class extends the gtk.TextBuffer to support syntax-highlighting. 
         You can use this class like a normal TextBuffer. """
         
+    # number of lines lexed at once, doubled if a token doesn't fit
+    window_lines = 32
+    
+    # seconds the highlighting may block the main loop when idle, and after 
+    #   an edit until the visible text is highlighted
+    time_slice   = 0.01
+    visible_time = 0.1
+        
     def __init__(self, table=None, lang=None, styles={}):
         """ The constructor takes 3 optional arguments. 
         
@@ -542,7 +765,19 @@ class CodeBuffer(gtk.TextBuffer):
         # store lang-definition
         self._lang_def = lang
         
+        # lexer-state at the start of each line: the number of characters 
+        #   since the end of the last token before the line, i.e. where the
+        #   lexer has to resume to get the same tokens.
+        self._states = [0]
+        
+        # the pending update: [mark to continue at, mark of the end of the 
+        #   edited text or None, window size]
+        self._job = None
+        self._idle_id = None
+        self._views = []
+        
         self.connect_after("insert-text", self._on_insert_text)
+        self.connect("delete-range", self._on_before_delete_range)
         self.connect_after("delete-range", self._on_delete_range)
         self.connect('apply-tag', self._on_apply_tag)
         
@@ -556,92 +791,251 @@ class CodeBuffer(gtk.TextBuffer):
             self.emit_stop_by_name('apply-tag')
             return True
             
-        _log_debug("tag \"%s\" as %s"%(self.get_slice(start,end), tag.get_property("name")))
+        if DEBUG_FLAG:
+            _log_debug("tag \"%s\" as %s", self.get_slice(start,end), 
+                       tag.get_property("name"))
             
                             
     def _on_insert_text(self, buf, it, text, length):
         # if no syntax defined -> nop
         if not self._lang_def: return False
         
-        it = it.copy()
-        it.backward_chars(length)
+        # length is in bytes
+        start = it.copy()
+        start.backward_chars(len(text.decode('utf-8')))
         
-        if not it.begins_tag():
-            it.backward_to_tag_toggle(None)
-            _log_debug("Not tag-start -> moved iter to %i (%s)"%(it.get_offset(), it.get_char()))
-
-        if it.begins_tag(self.get_tag_table().lookup("DEFAULT")):
-            it.backward_to_tag_toggle(None)
-            _log_debug("Iter at DEFAULT-start -> moved to %i (%s)"%(it.get_offset(), it.get_char()))
+        # the lexer-states of the new lines are unknown until re-lexed
+        line = start.get_line()
+        self._states[line+1:line+1] = [_UNKNOWN]*text.count('\n')
             
         self._apply_tags = True    
-        self.update_syntax(it)        
+        self.update_syntax(start, it)        
         self._apply_tags = False
         
         
+    def _on_before_delete_range(self, buf, start, end):
+        # if no syntax defined -> nop
+        if not self._lang_def: return False
+        
+        # drop the lexer-states of the deleted lines
+        del self._states[start.get_line()+1:end.get_line()+1]
+        
+        
     def _on_delete_range(self, buf, start, end):
         # if no syntax defined -> nop
         if not self._lang_def: return False
 
-        start = start.copy()
-        if not start.begins_tag():
-            start.backward_to_tag_toggle(None)
-    
         self._apply_tags = True                
-        self.update_syntax(start)        
+        self.update_syntax(start, start)        
         self._apply_tags = False
         
     
     def update_syntax(self, start, end=None):
         """ More or less internal used method to update the 
-            syntax-highlighting. """
+            syntax-highlighting. 
+            
+            The text is re-lexed from the line before start on. If end is 
+            given, everything after end is assumed to be highlighted already:
+            Lexing stops at the first line after end, whose lexer-state 
+            equals the one stored before. So the work done for an edit does 
+            not depend on the length of the text. Without end, everything up 
+            to the end of the buffer is re-highlighted. 
+            
+            The work is done in slices of time_slice seconds when the main 
+            loop is idle, so long texts don't block the user interface. Only
+            the visible text (or the edited text, if there is no view) is 
+            highlighted immediately. Pending work of earlier updates is merged
+            into this update. """
         # if no lang set    
         if not self._lang_def: return             
-        _log_debug("Update syntax from %i"%start.get_offset())
-            
-        # if not end defined
-        if not end: end = self.get_end_iter()
-        
-        # We do not use recursion -> long files exceed rec-limit!
-        finished = False
-        while not finished: 
-            # search first rule matching txt[start..end]            
-            mstart, mend, tagname = self._lang_def(self, start, end)
-
-            # optimisation: if mstart-mend is allready tagged with tagname 
-            #   -> finished
-            if tagname:     #if something found
-                tag = self.get_tag_table().lookup(tagname)
-                if mstart.begins_tag(tag) and mend.ends_tag(tag) and not mstart.equal(start):
-                    self.remove_all_tags(start,mstart)
-                    self.apply_tag_by_name("DEFAULT", start, mstart)
-                    _log_debug("Optimized: Found old tag at %i (%s)"%(mstart.get_offset(), mstart.get_char()))
-                    # finish
-                    finished = True
-                    continue
-                    
-            # remove all tags from start..mend (mend == buffer-end if no match)        
-            self.remove_all_tags(start, mend)
-            # make start..mstart = DEFAUL (mstart == buffer-end if no match)
-            if not start.equal(mstart):
-                _log_debug("Apply DEFAULT")
-                self.apply_tag_by_name("DEFAULT", start, mstart)                
+        _log_debug("Update syntax from %i", start.get_offset())
+        
+        offset = start.get_offset()
+        limit  = end and end.get_offset()
+        
+        # resume where the lexer was, when it reached the line before, as 
+        #   the tokens of that line may look ahead into the edited one
+        line = max(start.get_line()-1, 0)
+        it = self.get_iter_at_line(line)
+        
+        if self._job and self._job_pos() <= it.get_offset():
+            # the pending update did not reach the line yet
+            pos = self._job_pos()
+        else:
+            it.backward_chars(self._states[line])
+            pos = it.get_offset()
+        
+        if self._job:
+            # merge the pending update into this one
+            if limit is not None and self._job[1]:
+                job_limit = self.get_iter_at_mark(self._job[1])
+                limit = max(limit, job_limit.get_offset())
+            else:
+                limit = None
+            self._cancel_job()
+        
+        # the marks move along with later edits
+        limit_mark = None
+        if limit is not None:
+            limit_mark = self.create_mark(None, self.get_iter_at_offset(limit))
+        self._job = [self.create_mark(None, self.get_iter_at_offset(pos), True),
+                     limit_mark, self.window_lines]
+        
+        until = self._visible_end()
+        if until is None: until = limit or offset
+        
+        if self._run_job(self.visible_time, until):
+            self._idle_id = gobject.idle_add(self._on_idle)
+            
+            
+    def add_view(self, view):
+        """ Registers a gtk.TextView showing this buffer. Its visible text is
+            highlighted first. """
+        self._views.append(view)
+        
+        
+    def _visible_end(self):
+        """ Internal used method. Returns the offset of the end of the text 
+            visible in the views, None if there are none. """
+        end = None
+        for view in self._views:
+            rect = view.get_visible_rect()
+            it = view.get_iter_at_location(rect.x+rect.width, rect.y+rect.height)
+            end = max(end, it.get_offset())
+        return end
+        
+        
+    def _job_pos(self):
+        """ Internal used method. Returns the offset the pending update 
+            continues at. """
+        return self.get_iter_at_mark(self._job[0]).get_offset()
+        
+        
+    def _cancel_job(self):
+        """ Internal used method. Drops the pending update. """
+        if not self._job: return
         
+        for mark in self._job[:2]:
+            if mark: self.delete_mark(mark)
+        self._job = None
+        
+        if self._idle_id is not None:
+            gobject.source_remove(self._idle_id)
+            self._idle_id = None
+        
+        
+    def _run_job(self, budget, until=None):
+        """ Internal used method. Continues the pending update for budget 
+            seconds, but stops as soon as it reached the offset until. Returns 
+            True if there is work left. """
+        deadline = time.time()+budget
+        
+        while self._job:
+            pos_mark, limit_mark, lines = self._job
+            pos   = self.get_iter_at_mark(pos_mark).get_offset()
+            limit = None
+            if limit_mark: 
+                limit = self.get_iter_at_mark(limit_mark).get_offset()
+            
+            nxt = self._update_window(pos, lines, limit)
+            if nxt is None:
+                self._cancel_job()
+                return False
+            
+            # grow the window only if no token fitted into it
+            self._job[2] = nxt > pos and self.window_lines or lines*2
+            self.move_mark(pos_mark, self.get_iter_at_offset(nxt))
+            
+            if time.time() > deadline or (until is not None and nxt >= until):
+                return True
+                
+                
+    def _on_idle(self):
+        # the source is removed by returning False, not by _cancel_job()
+        idle_id, self._idle_id = self._idle_id, None
+        
+        self._apply_tags = True
+        more = self._run_job(self.time_slice)
+        self._apply_tags = False
+        
+        if more: self._idle_id = idle_id
+        return more
+            
+            
+    def _update_window(self, pos, lines, limit):
+        """ Internal used method. Highlights the text from offset pos on, 
+            which must be the end of a token (or a position stored in a 
+            lexer-state), reading the given number of lines. Returns the 
+            offset to continue at or None if finished. 
+            
+            Only the tokens ending before the last line read are applied, so 
+            the patterns may look ahead one line. """
+        start = self.get_iter_at_offset(pos)
+        line  = start.get_line()
+        
+        if line+lines < self.get_line_count():
+            end = self.get_iter_at_line(line+lines)
+        else:
+            end = self.get_end_iter()
+        at_end = end.is_end()
+        
+        txt  = self.get_slice(start, end).decode('utf-8')
+        safe = len(txt)
+        if not at_end: safe = txt.rfind('\n', 0, len(txt)-1)+1
+        
+        # offset (in txt) of the start of the next line
+        nxt = txt.find('\n')+1 or len(txt)+1
+        if start.starts_line():
+            nxt = 0; line -= 1
+        done = 0
+        
+        for moff, eoff, tagname in self._lang_def.scan(txt):
+            if not at_end and (not tagname or eoff > safe):
+                # window too small -> continue from the last token
+                return pos+done
+            
+            # the lines starting before or in the token were reached from 
+            #   the end of the last token
+            while nxt <= moff or nxt < eoff:
+                line += 1
+                state = nxt-done
+                
+                # converged -> the rest is highlighted already
+                if limit is not None and pos+done >= limit and \
+                        pos+nxt > limit and state == self._states[line]:
+                    return None
+                
+                self._states[line] = state
+                nxt = txt.find('\n', nxt)+1 or len(txt)+1
+            
+            self._apply_token(pos+done, pos+moff, pos+eoff, tagname)
+            
             # nothing found -> finished
             if not tagname: 
-                finished = True
-                continue
+                return None
+            
+            done = eoff
+        
         
+    def _apply_token(self, pos, mstart, mend, tagname):
+        """ Internal used method. Tags mstart..mend with tagname and 
+            pos..mstart as DEFAULT. """
+        start  = self.get_iter_at_offset(pos)
+        mstart = self.get_iter_at_offset(mstart)
+        mend   = self.get_iter_at_offset(mend)
+                    
+        # remove all tags from start..mend (mend == buffer-end if no match)        
+        self.remove_all_tags(start, mend)
+        # make start..mstart = DEFAUL (mstart == buffer-end if no match)
+        if not start.equal(mstart):
+            _log_debug("Apply DEFAULT")
+            self.apply_tag_by_name("DEFAULT", start, mstart)                
+    
+        if tagname:
             # apply tag
-            _log_debug("Apply %s"%tagname)
+            _log_debug("Apply %s", tagname)
             self.apply_tag_by_name(tagname, mstart, mend)
-
-            start = mend
             
-            if start == end: 
-                finished = True                 
-                continue
-                
         
     def reset_language(self, lang_def):
         """ Reset the currently used language-definition. """
@@ -654,6 +1048,8 @@ class CodeBuffer(gtk.TextBuffer):
         if self._lang_def:
             self.update_styles(self._lang_def.get_styles())
         # and ...
+        self._cancel_job()
+        self._states = [0] + [_UNKNOWN]*(self.get_line_count()-1)
         self._apply_tags = True
         self.update_syntax(start)
         self._apply_tags = False
@@ -670,11 +1066,11 @@ class CodeBuffer(gtk.TextBuffer):
             style.update(props)
             # if tagname is unknown:
             if not table.lookup(name):
-                _log_debug("Create tag: %s (%s)"%(name, style))
+                _log_debug("Create tag: %s (%s)", name, style)
                 self.create_tag(name, **style) 
             else: # update tag
                 tag = table.lookup(name)
-                _log_debug("Update tag %s with (%s)"%(name, style))
+                _log_debug("Update tag %s with (%s)", name, style)
                 map(lambda i: tag.set_property(i[0],i[1]), style.items())
 
                         
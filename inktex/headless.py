@@ -0,0 +1,194 @@
+#!/usr/bin/env python2
+
+"""
+Render LaTeX snippets without Inkscape and without the GTK dialog, e.g. to
+generate figure labels from scripts.
+
+As a command line tool, the snippets are taken from the arguments, from a
+file or from the standard input. In files and on the standard input,
+snippets are separated by lines containing only %%.
+
+    python headless.py [options] [SNIPPET...]
+
+The result is a new svg document containing one group per snippet or, if
+--document is given, the document with the groups appended. If the output
+file name contains %d, one document per snippet is written instead.
+
+From python, use render_many():
+
+    from headless import render_many
+    groups = render_many([r'$x^2$', r'$\\alpha$'], {'scale': 2.0})
+
+The modules inkex and simpletransform come with Inkscape (0.48 to 0.92). If
+they are not on the PYTHONPATH, they are looked up in the usual extension
+directories of Inkscape, see INKSCAPE_EXTENSIONS. If Inkscape is installed
+elsewhere, set e.g.
+
+    PYTHONPATH=/usr/share/inkscape/extensions python headless.py ...
+"""
+
+import os
+import sys
+import optparse
+
+# the directories containing inkex.py, after the PYTHONPATH
+INKSCAPE_EXTENSIONS = [
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    '/usr/share/inkscape/extensions',
+    '/usr/local/share/inkscape/extensions',
+    '/Applications/Inkscape.app/Contents/Resources/share/inkscape/extensions',
+]
+sys.path.extend(d for d in INKSCAPE_EXTENSIONS
+                if os.path.isdir(d) and d not in sys.path)
+
+import inkex
+
+from converter import Converter
+from ids import IdIndex
+
+
+class HeadlessEffect(object):
+    """
+    Stands in for the InkTex effect class, which the Converter needs to
+    allocate unique ids. If a document is given, the ids are unique with
+    respect to it.
+    """
+
+    def __init__(self, document=None):
+        root = None
+        if document is not None:
+            root = getattr(document, 'getroot', lambda: document)()
+        self.ids = IdIndex(root)
+
+    def unique_id(self, old_id):
+        return self.ids.unique(old_id)
+
+
+def render_many(snippets, settings=None, document=None,
+                output_callback=None):
+    """Renders a list of LaTeX snippets in a single LaTeX run and returns a
+    list with one svg group per snippet (None for empty snippets). The
+    groups carry the same InkTeX attributes as the ones created in Inkscape,
+    so they can be edited there later. settings is a dict like the one of
+    the settings tab, e.g. {'preamble': 'preamble.tex', 'scale': 2.0}."""
+
+    settings = settings or {}
+    effect = HeadlessEffect(document)
+
+    with Converter(effect, output_callback) as renderer:
+        groups = renderer.render_many(snippets, settings)
+
+        preamble_code = renderer.get_preamble(settings)
+        attributes = renderer.get_fingerprint(settings)
+        attributes['scale'] = repr(renderer.get_scale(settings))
+
+        for src, group in zip(snippets, groups):
+            if group is None:
+                continue
+
+            group.attrib[Converter.add_ns('src', ns=u'inktex')] = \
+                src.encode('string-escape')
+            group.attrib[Converter.add_ns('key', ns=u'inktex')] = \
+                renderer.cache_key(src, preamble_code)
+            for name, value in attributes.iteritems():
+                group.attrib[Converter.add_ns(name, ns=u'inktex')] = value
+
+    return groups
+
+
+def read_snippets(stream):
+    """Reads snippets separated by lines containing only %%"""
+
+    snippets = [[]]
+    for line in stream:
+        if line.strip() == '%%':
+            snippets.append([])
+        else:
+            snippets[-1].append(line)
+
+    return [''.join(lines).strip() for lines in snippets
+            if ''.join(lines).strip()]
+
+
+def new_document():
+    """Returns an empty svg document"""
+
+    return inkex.etree.ElementTree(inkex.etree.fromstring(
+        '<svg xmlns="%s" xmlns:xlink="%s" xmlns:inktex="%s"/>' % (
+            Converter.namespaces[u'svg'], Converter.namespaces[u'xlink'],
+            Converter.namespaces[u'inktex'])))
+
+
+def write_document(document, filename):
+    """Writes a document to a file or, if filename is -, to stdout"""
+
+    if filename == '-':
+        document.write(sys.stdout)
+    else:
+        document.write(filename)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [SNIPPET...]")
+    parser.add_option("-f", "--file", dest="file",
+                      help="read the snippets from FILE, - for stdin")
+    parser.add_option("-p", "--preamble", dest="preamble",
+                      help="preamble file")
+    parser.add_option("-s", "--scale", dest="scale", type="float",
+                      default=1.0, help="scale factor")
+    parser.add_option("-t", "--timeout", dest="timeout", type="float",
+                      default=0, help="timeout in seconds, 0 for none")
+    parser.add_option("-m", "--minify", dest="precision", type="int",
+                      help="minify the svg, rounding to PRECISION decimal "
+                           "places")
+    parser.add_option("-d", "--document", dest="document",
+                      help="append the groups to this svg document")
+    parser.add_option("-o", "--output", dest="output", default="-",
+                      help="output file, - for stdout (default). If it "
+                           "contains %d, one file per snippet is written")
+    options, args = parser.parse_args()
+
+    if options.file == '-' or (not options.file and not args):
+        snippets = read_snippets(sys.stdin)
+    elif options.file:
+        with open(options.file, 'r') as f:
+            snippets = read_snippets(f)
+    else:
+        snippets = args
+
+    settings = {'scale': options.scale, 'timeout': options.timeout}
+    if options.preamble:
+        settings['preamble'] = options.preamble
+    if options.precision is not None:
+        settings['minify'] = True
+        settings['precision'] = options.precision
+
+    document = None
+    if options.document:
+        document = inkex.etree.parse(options.document)
+
+    try:
+        groups = render_many(snippets, settings, document)
+    except Exception, e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    if '%d' in options.output and document is None:
+        for i, group in enumerate(groups):
+            if group is None:
+                continue
+            doc = new_document()
+            doc.getroot().append(group)
+            write_document(doc, options.output % (i + 1))
+        return
+
+    if document is None:
+        document = new_document()
+    for group in groups:
+        if group is not None:
+            document.getroot().append(group)
+    write_document(document, options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import random
+import threading
+
+
+class IdIndex(object):
+    """
+    The set of ids used in the document. It is collected once when the
+    extension starts and updated whenever a new id is allocated, so finding
+    an unused id doesn't need to search the whole document.
+    """
+
+    id_chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, root=None):
+        self.ids = set()
+        self.lock = threading.Lock()
+
+        if root is not None:
+            self.update(root)
+
+    def update(self, root):
+        """Adds the ids of all elements below root to the index"""
+
+        for el in root.iter():
+            el_id = el.get('id') if isinstance(el.tag, basestring) else None
+            if el_id:
+                self.ids.add(el_id)
+
+    def __contains__(self, el_id):
+        return el_id in self.ids
+
+    def unique(self, old_id):
+        """Returns an id based on old_id, which is not used in the document
+        yet, and marks it as used. Like inkex' uniqueId, random characters
+        are appended until the id is unique."""
+
+        with self.lock:
+            new_id = old_id
+            while new_id in self.ids:
+                new_id += random.choice(self.id_chars)
+            self.ids.add(new_id)
+            return new_id
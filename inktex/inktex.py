@@ -46,8 +46,12 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a
 new document, these information must be set again.
 """
 
+import timing
+
 from inktex_cls import InkTex
 
+timing.mark('imported')
+
 if __name__ == "__main__":
     it = InkTex()
     it.affect()
\ No newline at end of file
@@ -1,7 +1,11 @@
 import inkex
+import simpletransform
 
 from converter import Converter
-from ui import Ui
+from ids import IdIndex
+from library import GlyphLibrary, SymbolLibrary
+from scheduler import RenderScheduler
+import timing
 
 
 class InkTex(inkex.Effect):
@@ -19,13 +23,40 @@ class InkTex(inkex.Effect):
         self.orig_src = None
         self.new = None
         self.new_src = None
+        self.new_key = None
+        self.new_scale = None
+        self.new_fingerprint = None
+
+        # the running Converter or RenderScheduler, so it can be cancelled
+        self.renderer = None
+        self.preview_renderer = None
+
+        # all ids used in the document, see unique_id()
+        self.ids = None
 
     def effect(self):
         """If there is an original element, store it. Open the GUI."""
 
+        timing.mark('document loaded')
+
+        # GTK is imported only when the dialog is actually needed
+        from ui import Ui
+
+        self.ids = IdIndex(self.document.getroot())
         self.orig, self.orig_src = self.get_original()
 
-        self.ui = Ui(self.render, self.orig_src, self.get_settings())
+        # offer to re-render the selection, if several objects are selected
+        render_selection = None
+        if len(self.get_originals()) > 1:
+            render_selection = self.render_selection
+
+        self.ui = Ui(self.render, self.orig_src, self.get_settings(),
+                     render_all_callback=self.render_all,
+                     render_selection_callback=render_selection,
+                     render_outdated_callback=self.render_outdated,
+                     cancel_callback=self.cancel,
+                     preview_callback=self.preview,
+                     cancel_preview_callback=self.cancel_preview)
         self.ui.main()
 
     def render(self, tex, settings):
@@ -34,28 +65,323 @@ class InkTex(inkex.Effect):
         self.new_src = tex
         self.store_settings(settings)
 
-        with Converter(self) as renderer:
+        with Converter(self, self.ui.append_log) as renderer:
+            self.renderer = renderer
             try:
-                self.new = renderer.render(self.new_src, settings)
+                self.new_key = self.get_keys([tex], settings)[0]
+                self.new_scale = renderer.get_scale(settings)
+                self.new_fingerprint = renderer.get_fingerprint(settings)
+
+                # nothing to render, if the source and preamble didn't change
+                if self.reuse_original():
+                    return True
+
+                self.new = self.get_clone(settings)
+                if self.new is None:
+                    self.new = renderer.render(self.new_src, settings,
+                                               self.get_glyphs(settings))
                 self.copy_styles()
                 self.store_src_information()
                 self.append_or_replace()
+                self.prune_libraries()
 
                 return True
             except Exception, e:
                 self.ui.log(e.message)
 
+    def render_all(self, settings):
+        """Re-render all InkTeX objects of the document in a single LaTeX
+        run, e.g. after the preamble changed."""
+
+        groups = self.document.xpath('//svg:g[@inktex:src]',
+            namespaces=Converter.namespaces)
+
+        return self.render_groups(groups, settings)
+
+    def render_outdated(self, settings):
+        """Re-render only the InkTeX objects, that are outdated, i.e. were
+        rendered with another preamble or compiler/converter version. Objects
+        that differ in the scale factor only are rescaled."""
+
+        groups = self.document.xpath('//svg:g[@inktex:src]',
+            namespaces=Converter.namespaces)
+
+        src_attrib = Converter.add_ns('src', ns=u'inktex')
+        srcs = [g.attrib[src_attrib].decode('string-escape') for g in groups]
+
+        return self.render_groups(self.get_changed(groups, srcs, settings),
+                                  settings)
+
+    def render_groups(self, groups, settings):
+        """Render the sources of the given InkTeX groups in one batch and
+        swap the new objects in place."""
+
+        src_attrib = Converter.add_ns('src', ns=u'inktex')
+        srcs = [g.attrib[src_attrib].decode('string-escape') for g in groups]
+
+        self.store_settings(settings)
+
+        with Converter(self, self.ui.append_log) as renderer:
+            self.renderer = renderer
+            try:
+                news = renderer.render_many(
+                    self.get_render_srcs(srcs, settings), settings,
+                    self.get_glyphs(settings))
+            except Exception, e:
+                self.ui.log(e.message)
+                return False
+
+        self.replace_groups(groups, srcs, news, settings)
+        return True
+
+    def render_selection(self, settings):
+        """Re-render all selected InkTeX objects, e.g. after a scale change.
+        The objects are rendered concurrently."""
+
+        src_attrib = Converter.add_ns('src', ns=u'inktex')
+
+        groups = self.get_originals()
+        srcs = [g.attrib[src_attrib].decode('string-escape') for g in groups]
+
+        # only the objects with changed sources or preamble are rendered
+        groups = self.get_changed(groups, srcs, settings)
+        srcs = [g.attrib[src_attrib].decode('string-escape') for g in groups]
+
+        self.store_settings(settings)
+
+        try:
+            self.renderer = RenderScheduler(self, settings.get('workers'),
+                                            self.ui.append_log)
+            news = self.renderer.run(self.get_render_srcs(srcs, settings),
+                                     settings, self.get_glyphs(settings))
+        except Exception, e:
+            self.ui.log(e.message)
+            return False
+
+        self.replace_groups(groups, srcs, news, settings)
+        return True
+
+    def get_render_srcs(self, srcs, settings):
+        """Returns the sources to render in a batch. If identical objects
+        are cloned, the ones that become clones of a symbol, or of an
+        object rendered earlier in the batch, are left empty, so they are
+        not rendered."""
+
+        if str(settings.get('clone_identical', False)) != 'True':
+            return srcs
+
+        symbols = SymbolLibrary(self.document.getroot(), self.unique_id)
+        seen = set()
+        render_srcs = []
+
+        for src, key in zip(srcs, self.get_keys(srcs, settings)):
+            if key in seen or symbols.find(key) is not None:
+                render_srcs.append('')
+            else:
+                seen.add(key)
+                render_srcs.append(src)
+
+        return render_srcs
+
+    def replace_groups(self, groups, srcs, news, settings):
+        """Swap the given InkTeX groups with newly rendered ones or, if
+        identical objects are cloned, with clones"""
+
+        keys = self.get_keys(srcs, settings)
+        self.new_scale = Converter(self).get_scale(settings)
+        self.new_fingerprint = Converter(self).get_fingerprint(settings)
+
+        for orig, src, key, new in zip(groups, srcs, keys, news):
+            self.orig, self.new_src, self.new_key = orig, src, key
+            self.new = None
+            if src.strip():
+                self.new = self.get_clone(settings)
+            if self.new is None:
+                self.new = new
+            if self.new is None:
+                continue
+
+            self.copy_styles()
+            self.store_src_information()
+            self.append_or_replace()
+
+        self.prune_libraries()
+
+    def get_glyphs(self, settings):
+        """Returns the document's GlyphLibrary, if glyphs should be shared
+        between the InkTeX objects, or None"""
+
+        if str(settings.get('share_glyphs', False)) == 'True':
+            return GlyphLibrary(self.document.getroot())
+        return None
+
+    def get_keys(self, srcs, settings):
+        """Returns the keys identifying the rendering of the given sources
+        with the given settings, apart from the scale factor"""
+
+        renderer = Converter(self)
+        preamble_code = renderer.get_preamble(settings)
+        return [renderer.cache_key(src, preamble_code) for src in srcs]
+
+    def get_changed(self, groups, srcs, settings):
+        """Returns the groups, that need to be rendered again with the given
+        settings. All the others are reused, see reuse_original(). Objects
+        rendered before the source, the preamble, the toolchain or the
+        minification changed are included, as their key or fingerprint
+        doesn't match anymore."""
+
+        keys = self.get_keys(srcs, settings)
+        self.new_scale = Converter(self).get_scale(settings)
+        self.new_fingerprint = Converter(self).get_fingerprint(settings)
+
+        changed = []
+        for group, key in zip(groups, keys):
+            self.orig, self.new_key = group, key
+            if not self.reuse_original():
+                changed.append(group)
+
+        self.orig = None
+        return changed
+
+    def reuse_original(self):
+        """If the original object was rendered from the same source and its
+        fingerprint (preamble, toolchain and minification) matches the
+        current one, it is kept and only its transform is adapted to a
+        changed scale factor, so nothing needs to be rendered. Returns
+        whether the original object was reused."""
+
+        key_attrib = Converter.add_ns('key', ns=u'inktex')
+        scale_attrib = Converter.add_ns('scale', ns=u'inktex')
+
+        if self.orig is None or self.new_key is None or \
+                self.orig.get(key_attrib) != self.new_key or \
+                self.orig.get(scale_attrib) is None:
+            return False
+
+        fingerprint = self.new_fingerprint or {}
+        for name in Converter.fingerprint_names:
+            if self.orig.get(Converter.add_ns(name, ns=u'inktex')) != \
+                    fingerprint.get(name):
+                return False
+
+        # the geometry stays the same, and so does the scale baked into it
+        transform = self.rescale_transform(self.orig.get('transform'),
+                                           self.get_baked(self.orig))
+        if transform is not None:
+            self.orig.attrib['transform'] = transform
+        self.orig.attrib[scale_attrib] = repr(self.new_scale)
+
+        return True
+
+    def get_baked(self, group):
+        """Returns the part of the scale factor, that is baked into the
+        coordinates of a group by the Minifier"""
+
+        try:
+            return float(group.get(Converter.add_ns('baked', ns=u'inktex'),
+                                   1.0))
+        except ValueError:
+            return 1.0
+
+    def rescale_transform(self, transform, baked=1.0):
+        """The transform of the original object includes the scale factor it
+        was rendered with, except for the part baked into its coordinates.
+        Returns the transform with that factor replaced by the new one, of
+        which the given part is baked into the new coordinates."""
+
+        scale_attrib = Converter.add_ns('scale', ns=u'inktex')
+
+        try:
+            old_scale = float(self.orig.get(scale_attrib))
+            ratio = (self.new_scale / baked) / \
+                (old_scale / self.get_baked(self.orig))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return transform
+
+        if ratio == 1.0:
+            return transform
+
+        matrix = simpletransform.composeTransform(
+            simpletransform.parseTransform(transform),
+            [[ratio, 0.0, 0.0], [0.0, ratio, 0.0]])
+        return simpletransform.formatTransform(matrix)
+
+    def get_clone(self, settings):
+        """If identical objects should be cloned and there already is an
+        object with the same source and preamble, return a clone of it,
+        scaled by new_scale. Returns None otherwise."""
+
+        if str(settings.get('clone_identical', False)) != 'True':
+            return None
+
+        symbols = SymbolLibrary(self.document.getroot(), self.unique_id)
+        symbol_id = symbols.find(self.new_key)
+
+        if symbol_id is None:
+            # turn the existing object into the first clone
+            groups = self.document.xpath('//*[@inktex:key=$key]',
+                namespaces=Converter.namespaces, key=self.new_key)
+            for group in groups:
+                if group is not self.orig and not symbols.is_clone(group):
+                    symbol_id = symbols.adopt(group, self.new_key)
+                    break
+
+        if symbol_id is None:
+            return None
+
+        return symbols.clone(symbol_id, self.new_scale)
+
+    def prune_libraries(self):
+        """Remove the symbols and glyphs from the libraries, that are not
+        used anymore after objects were replaced or deleted"""
+
+        SymbolLibrary(self.document.getroot(), self.unique_id).prune()
+        GlyphLibrary(self.document.getroot()).prune()
+
+    def cancel(self):
+        """Cancel the running rendering. This is called from the UI thread,
+        while the rendering runs in a worker thread."""
+
+        if self.renderer is not None:
+            self.renderer.cancel()
+
+    def preview(self, tex, settings, dpi=None):
+        """Returns a png or svg image of the LaTeX code for the preview.
+        The intermediate results go to the render cache, so applying the
+        same code later doesn't need to run latex again."""
+
+        with Converter(self) as renderer:
+            self.preview_renderer = renderer
+            try:
+                return renderer.preview(tex, settings, dpi)
+            finally:
+                self.preview_renderer = None
+
+    def cancel_preview(self):
+        """Cancel the running preview rendering"""
+
+        renderer = self.preview_renderer
+        if renderer is not None:
+            renderer.cancel()
+
     def append_or_replace(self):
         """Appends the new object to the document or, if we edited an old
-        one, replace the old one."""
+        one, replace the old one at its position."""
 
         if self.orig is not None:
-            parent = self.orig.getparent()
-            parent.remove(self.orig)
-            parent.append(self.new)
+            self.orig.getparent().replace(self.orig, self.new)
         else:
             self.current_layer.append(self.new)
 
+    def unique_id(self, old_id):
+        """Returns an id based on old_id, that is not used in the document.
+        Unlike inkex' uniqueId, this doesn't search the document, but uses
+        the index of ids built when the extension started."""
+
+        if self.ids is None:
+            self.ids = IdIndex(self.document.getroot())
+        return self.ids.unique(old_id)
+
     def error(self, msg):
         """Display an error in the UI"""
 
@@ -77,6 +403,16 @@ class InkTex(inkex.Effect):
 
         return None, None
 
+    def get_originals(self):
+        """Returns all selected inktex objects"""
+
+        src_attrib = Converter.add_ns('src', ns=u'inktex')
+        g_tag = Converter.add_ns('g', ns=u'svg')
+
+        return [self.selected[i] for i in self.options.ids
+                if self.selected[i].tag == g_tag and
+                src_attrib in self.selected[i].attrib]
+
     def get_settings(self):
         """Gets a dictionary with the inktex settings stored in the
         svg/metadata part of the svg doc."""
@@ -119,6 +455,18 @@ class InkTex(inkex.Effect):
         self.new.attrib[Converter.add_ns('src', ns=u'inktex')] = \
             self.new_src.encode('string-escape')
 
+        # used to find identical objects and unchanged sources
+        if self.new_key:
+            self.new.attrib[Converter.add_ns('key', ns=u'inktex')] = \
+                self.new_key
+        if self.new_scale is not None:
+            self.new.attrib[Converter.add_ns('scale', ns=u'inktex')] = \
+                repr(self.new_scale)
+
+        # tells, which preamble and toolchain the object was rendered with
+        for name, value in (self.new_fingerprint or {}).iteritems():
+            self.new.attrib[Converter.add_ns(name, ns=u'inktex')] = value
+
 
     def copy_styles(self):
         """Copy the styles and transforms if we edited an old element.
@@ -132,13 +480,43 @@ class InkTex(inkex.Effect):
             return
 
         if transform_attrib in self.orig.attrib:
-            self.new.attrib[transform_attrib] = \
-                self.orig.attrib[transform_attrib]
+            self.new.attrib[transform_attrib] = self.rescale_transform(
+                self.orig.attrib[transform_attrib], self.get_baked(self.new))
 
         if transform_attrib_ns in self.orig.attrib:
-            self.new.attrib[transform_attrib] = \
-                self.orig.attrib[transform_attrib_ns]
+            self.new.attrib[transform_attrib] = self.rescale_transform(
+                self.orig.attrib[transform_attrib_ns],
+                self.get_baked(self.new))
 
         if style_attrib in self.orig.attrib:
             self.new.attrib[style_attrib] = self.orig.attrib[style_attrib]
 
+        self.align_baseline()
+
+    def align_baseline(self):
+        """Keep the baseline of the new object where the one of the original
+        object was, instead of its top edge, if the height of the snippet
+        changed. Both heights are stored on the groups when they are
+        rendered, so no additional latex run is needed."""
+
+        height_attrib = Converter.add_ns('height', ns=u'inktex')
+        scale_attrib = Converter.add_ns('scale', ns=u'inktex')
+
+        try:
+            old_height = float(self.orig.get(height_attrib)) * \
+                float(self.orig.get(scale_attrib)) / self.new_scale
+            new_height = float(self.new.get(height_attrib))
+        except (TypeError, ValueError, ZeroDivisionError):
+            return
+
+        # the shift in the user units of the new group, whose coordinates
+        # may include part of the scale factor
+        shift = (old_height - new_height) * self.get_baked(self.new)
+        if abs(shift) < 1e-6:
+            return
+
+        matrix = simpletransform.composeTransform(
+            simpletransform.parseTransform(self.new.get('transform')),
+            [[1.0, 0.0, 0.0], [0.0, 1.0, shift]])
+        self.new.attrib['transform'] = simpletransform.formatTransform(matrix)
+
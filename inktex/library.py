@@ -0,0 +1,228 @@
+import inkex
+
+from cache import hash_key
+from converter import Converter
+
+
+class DefsLibrary(object):
+    """
+    A <defs> block below the document root, identified by its id, holding
+    definitions shared by the InkTeX objects. Entries carry a key attribute,
+    by which they are looked up.
+    """
+
+    defs_id = None
+    key_attrib = None
+
+    def __init__(self, root):
+        self.root = root
+
+        self.defs_tag = Converter.add_ns('defs', ns=u'svg')
+        self.href_attrib = Converter.add_ns('href', ns=u'xlink')
+        self.key_attrib = Converter.add_ns(self.key_attrib, ns=u'inktex')
+
+        self.defs = None
+        self.entries = {}
+
+        for defs in self.root.iterchildren(self.defs_tag):
+            if defs.get('id') == self.defs_id:
+                self.defs = defs
+                break
+
+        if self.defs is not None:
+            for entry in self.defs:
+                key = entry.get(self.key_attrib)
+                if key:
+                    self.entries[key] = entry.get('id')
+
+    def find(self, key):
+        """Returns the id of the entry with the given key or None"""
+
+        return self.entries.get(key)
+
+    def get_defs(self):
+        """Returns the library's <defs>, which are created on first use"""
+
+        if self.defs is None:
+            self.defs = inkex.etree.Element(self.defs_tag)
+            self.defs.set('id', self.defs_id)
+            # definitions come first, so they are loaded before their uses
+            self.root.insert(0, self.defs)
+        return self.defs
+
+    def add(self, key, entry):
+        """Adds an element with an id to the library"""
+
+        entry.set(self.key_attrib, key)
+        self.get_defs().append(entry)
+        self.entries[key] = entry.get('id')
+
+    def prune(self):
+        """Removes the entries, that are not referenced in the document
+        anymore, e.g. because InkTeX objects were re-rendered or deleted.
+        Returns the number of removed entries."""
+
+        if self.defs is None:
+            return 0
+
+        used = set(
+            href[1:] for href in self.root.xpath('//@xlink:href',
+                                                 namespaces=inkex.NSS)
+            if href.startswith('#')
+        )
+
+        removed = 0
+        for entry in list(self.defs):
+            if entry.get('id') not in used:
+                self.entries.pop(entry.get(self.key_attrib), None)
+                self.defs.remove(entry)
+                removed += 1
+
+        if not len(self.defs):
+            self.root.remove(self.defs)
+            self.defs = None
+
+        return removed
+
+
+class GlyphLibrary(DefsLibrary):
+    """
+    A single <defs> block in the document, which holds the glyph outlines
+    of all InkTeX objects. dvisvgm puts a <path> definition into the <defs>
+    of each rendered svg for every glyph it uses, which are then referenced
+    by <use> elements. Instead of keeping these copies in every object,
+    identical glyphs are stored only once in the library and the <use>
+    elements point there.
+
+    Note that objects copied into another document lose their glyphs, as
+    the library is not copied along.
+    """
+
+    defs_id = 'inktex-glyphs'
+    key_attrib = 'glyph'
+
+    def __init__(self, root):
+        DefsLibrary.__init__(self, root)
+        self.path_tag = Converter.add_ns('path', ns=u'svg')
+
+    def fingerprint(self, path):
+        """Returns a hash of all attributes of a glyph path except its id"""
+
+        return hash_key(*['%s=%s' % item for item in sorted(path.items())
+                          if item[0] != 'id'])[:16]
+
+    def intern(self, group):
+        """Moves the glyph definitions of a rendered group to the library,
+        dropping the ones already in there, and points the <use> elements of
+        the group to the library's glyphs. Returns the number of glyphs that
+        were shared."""
+
+        href_map = {}
+        shared = 0
+
+        for defs in list(group.iter(self.defs_tag)):
+            for path in list(defs.iterchildren(self.path_tag)):
+                path_id = path.get('id')
+                if not path_id:
+                    continue
+
+                fingerprint = self.fingerprint(path)
+                glyph_id = self.find(fingerprint)
+
+                defs.remove(path)
+                if glyph_id is None:
+                    self.add(fingerprint, path)
+                    glyph_id = path_id
+                else:
+                    shared += 1
+
+                href_map['#' + path_id] = '#' + glyph_id
+
+            if not len(defs):
+                defs.getparent().remove(defs)
+
+        for el in group.iter():
+            href = el.get(self.href_attrib)
+            if href in href_map:
+                el.set(self.href_attrib, href_map[href])
+
+        return shared
+
+
+class SymbolLibrary(DefsLibrary):
+    """
+    A <defs> block in the document with <symbol>s, that hold the contents
+    of InkTeX objects rendered more than once. Identical objects (same
+    source and preamble) are then <use> clones of the same symbol instead
+    of copies of the geometry. Each clone is a regular InkTeX group, which
+    keeps its own source, so it can be edited independently later.
+    """
+
+    defs_id = 'inktex-symbols'
+    key_attrib = 'symbol'
+
+    def __init__(self, root, unique_id):
+        DefsLibrary.__init__(self, root)
+        self.unique_id = unique_id
+        self.symbol_tag = Converter.add_ns('symbol', ns=u'svg')
+        self.use_tag = Converter.add_ns('use', ns=u'svg')
+        self.baked_attrib = Converter.add_ns('baked', ns=u'inktex')
+
+        # the attributes of a rendered group, that describe its contents:
+        # the scale factor baked into the coordinates by the Minifier and
+        # the size of the snippet's box, used to align the baseline
+        self.content_attribs = [self.baked_attrib] + [
+            Converter.add_ns(name, ns=u'inktex')
+            for name in Converter.metrics]
+
+    def is_clone(self, group):
+        """Returns whether the group consists of a clone of a symbol"""
+
+        return len(group) == 1 and group[0].tag == self.use_tag and \
+            group[0].get(self.href_attrib, '')[1:] in self.entries.values()
+
+    def adopt(self, group, key):
+        """Moves the contents of a rendered group into a new symbol and puts
+        a clone of it into the group. Returns the symbol's id."""
+
+        symbol = inkex.etree.Element(self.symbol_tag)
+        symbol.set('id', self.unique_id('inktex-symbol'))
+        # the symbol must not clip its contents
+        symbol.set('style', 'overflow:visible')
+        for name in self.content_attribs:
+            if group.get(name):
+                symbol.set(name, group.get(name))
+
+        for c in list(group):
+            symbol.append(c)
+        self.add(key, symbol)
+
+        group.append(self.get_use(symbol.get('id')))
+        return symbol.get('id')
+
+    def get_use(self, symbol_id):
+        """Returns a <use> element referencing the symbol"""
+
+        use = inkex.etree.Element(self.use_tag)
+        use.set(self.href_attrib, '#' + symbol_id)
+        return use
+
+    def clone(self, symbol_id, scale=1.0):
+        """Returns a new group with a clone of the symbol, which looks just
+        like a freshly rendered group"""
+
+        group = inkex.etree.Element('g')
+        group.append(self.get_use(symbol_id))
+
+        symbol = self.defs.xpath('*[@id=$id]', id=symbol_id)[0]
+        for name in self.content_attribs:
+            if symbol.get(name):
+                group.set(name, symbol.get(name))
+
+        if symbol.get(self.baked_attrib):
+            scale /= float(symbol.get(self.baked_attrib))
+
+        if scale != 1.0:
+            group.attrib['transform'] = 'scale(%f,%f)' % (scale, scale)
+
+        return group
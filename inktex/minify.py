@@ -0,0 +1,336 @@
+import re
+
+import inkex
+import simpletransform
+
+# numpy is optional, it speeds up transforming and rounding the coordinates
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Minifier(object):
+    """
+    Post-processing of rendered svg groups to make them smaller. Transforms
+    of groups and paths, including the scale factor on the rendered group,
+    are baked into the path coordinates, all coordinates are rounded to the
+    given number of decimal places, and empty or redundant groups are
+    removed. The coordinates of all paths of a group are transformed and
+    rounded in one go, using numpy if it is installed.
+
+    Paths with arcs or strokes (whose width would change) and all other
+    elements keep their geometry and get the accumulated transform instead.
+
+    The glyphs of dvisvgm and pdf2svg are definitions placed with <use>
+    elements. Each of those would get the group's scale factor as a
+    transform of its own, so groups containing <use> elements keep their
+    transform, and only the rest is baked.
+    """
+
+    # number of coordinates of each path command
+    arguments = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4,
+                 'T': 2, 'A': 7, 'Z': 0}
+
+    token_re = re.compile(
+        r'([MmLlHhVvCcSsQqTtAaZz])|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+
+    identity = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+    def __init__(self, precision=3):
+        self.precision = int(precision)
+
+        self.g_tag = inkex.addNS('g', 'svg')
+        self.defs_tag = inkex.addNS('defs', 'svg')
+        self.path_tag = inkex.addNS('path', 'svg')
+        self.use_tag = inkex.addNS('use', 'svg')
+        self.symbol_tag = inkex.addNS('symbol', 'svg')
+
+    def minify(self, group):
+        """Minifies a rendered group in place. Returns whether the group's
+        transform was baked into the coordinates, i.e. the group has no
+        transform anymore."""
+
+        paths = []
+        matrix = self.parse_transform(group.get('transform'))
+
+        bake = not group.findall('.//' + self.use_tag)
+        if bake:
+            self.process(group, matrix, paths)
+            if 'transform' in group.attrib:
+                del group.attrib['transform']
+        else:
+            self.process(group, self.identity, paths)
+            self.set_transform(group, matrix)
+
+        self.transform_paths(paths)
+        return bake
+
+    def parse_transform(self, transform, matrix=None):
+        """Returns the matrix of a transform attribute"""
+
+        matrix = matrix or self.identity
+        if not transform:
+            return matrix
+        return simpletransform.parseTransform(transform, matrix)
+
+    def process(self, element, matrix, paths):
+        """Bake the accumulated transform matrix into the children of
+        element. Paths, whose coordinates are to be transformed, are
+        collected in paths as (element, segments, matrix) tuples."""
+
+        for child in list(element):
+            if not isinstance(child.tag, basestring):
+                element.remove(child)
+                continue
+
+            if child.tag in (self.defs_tag, self.symbol_tag):
+                # definitions are not rendered in place, only round them
+                self.process(child, self.identity, paths)
+                continue
+
+            child_matrix = self.parse_transform(child.get('transform'), matrix)
+
+            if self.has_references(child):
+                # clip paths, masks and paint servers are defined in the user
+                # space of the element, so the element keeps a transform
+                self.set_transform(child, child_matrix)
+                self.process(child, self.identity, paths)
+
+            elif child.tag in (self.g_tag, 'g'):
+                if 'transform' in child.attrib:
+                    del child.attrib['transform']
+                self.process(child, child_matrix, paths)
+
+                if not len(child) and not child.get('id'):
+                    element.remove(child)
+                elif not child.attrib:
+                    # a group without any attributes is redundant
+                    self.unwrap(child)
+
+            elif child.tag == self.path_tag and self.can_bake(child):
+                segments = self.parse_path(child.get('d', ''))
+                if segments is None:
+                    self.set_transform(child, child_matrix)
+                else:
+                    if 'transform' in child.attrib:
+                        del child.attrib['transform']
+                    paths.append((child, segments, child_matrix))
+
+            elif child.tag == self.use_tag:
+                # x and y are a translation applied after the transform
+                x = float(child.attrib.pop('x', 0) or 0)
+                y = float(child.attrib.pop('y', 0) or 0)
+                self.set_transform(child, simpletransform.composeTransform(
+                    child_matrix, [[1.0, 0.0, x], [0.0, 1.0, y]]))
+
+            else:
+                self.set_transform(child, child_matrix)
+
+    def has_references(self, element):
+        """Returns whether an element references e.g. a clip path"""
+
+        for value in element.attrib.values():
+            if 'url(' in value:
+                return True
+        return False
+
+    def unwrap(self, group):
+        """Replaces a group by its children"""
+
+        parent = group.getparent()
+        index = parent.index(group)
+        for i, c in enumerate(list(group)):
+            parent.insert(index + i, c)
+        parent.remove(group)
+
+    def can_bake(self, path):
+        """Transforms can't be baked into stroked paths, as the stroke width
+        would not be transformed"""
+
+        stroke = path.get('stroke')
+        for declaration in path.get('style', '').split(';'):
+            if ':' in declaration:
+                name, value = declaration.split(':', 1)
+                if name.strip() == 'stroke':
+                    stroke = value
+        return stroke is None or stroke.strip() == 'none'
+
+    def set_transform(self, element, matrix):
+        """Sets the transform attribute of an element in its shortest form"""
+
+        (a, c, e), (b, d, f) = [[self.round(v) for v in row] for row in matrix]
+
+        if (a, b, c, d) == (1, 0, 0, 1):
+            if (e, f) == (0, 0):
+                if 'transform' in element.attrib:
+                    del element.attrib['transform']
+                return
+            if element.tag == self.use_tag:
+                element.attrib['x'] = self.format(e)
+                element.attrib['y'] = self.format(f)
+                if 'transform' in element.attrib:
+                    del element.attrib['transform']
+                return
+            transform = 'translate(%s)' % self.format_numbers([e, f])
+        elif (b, c, e, f) == (0, 0, 0, 0):
+            transform = 'scale(%s)' % self.format_numbers(
+                [a] if a == d else [a, d])
+        else:
+            transform = 'matrix(%s)' % self.format_numbers([a, b, c, d, e, f])
+
+        element.attrib['transform'] = transform
+
+    def parse_path(self, d):
+        """Parses path data into a list of (command, points) segments with
+        absolute coordinates, where command is one of M, L, C, Q and Z.
+        Returns None for paths with arcs, which are not supported, and for
+        path data that can't be parsed, e.g. numbers after a closepath:
+
+        >>> Minifier().parse_path('M0 0Z1 1') is None
+        True
+        """
+
+        tokens = self.token_re.findall(d)
+        segments = []
+        x = y = 0.0
+        start = (0.0, 0.0)
+        control = None
+        command = None
+        i = 0
+
+        while i < len(tokens):
+            letter, number = tokens[i]
+            if letter:
+                command = letter
+                i += 1
+            elif command is None or not self.arguments[command.upper()]:
+                return None
+            elif command in 'Mm':
+                # further coordinate pairs after a moveto are linetos
+                command = 'l' if command == 'm' else 'L'
+
+            upper = command.upper()
+            if upper == 'A':
+                return None
+
+            count = self.arguments[upper]
+            args = []
+            for token in tokens[i:i + count]:
+                if token[0]:
+                    return None
+                args.append(float(token[1]))
+            if len(args) < count:
+                return None
+            i += count
+
+            relative = command.islower()
+            if upper == 'Z':
+                segments.append(('Z', []))
+                x, y = start
+                control = None
+                continue
+
+            if upper == 'H':
+                args = [args[0] + (x if relative else 0), y]
+                relative = False
+                upper = 'L'
+            elif upper == 'V':
+                args = [x, args[0] + (y if relative else 0)]
+                relative = False
+                upper = 'L'
+
+            points = [(args[j] + (x if relative else 0),
+                       args[j + 1] + (y if relative else 0))
+                      for j in range(0, len(args), 2)]
+
+            if upper in 'ST':
+                # the first control point is the reflection of the last one
+                last = segments[-1][0] if segments else None
+                if control is not None and \
+                        (upper == 'S' and last == 'C' or
+                         upper == 'T' and last == 'Q'):
+                    reflected = (2 * x - control[0], 2 * y - control[1])
+                else:
+                    reflected = (x, y)
+                points.insert(0, reflected)
+                upper = 'C' if upper == 'S' else 'Q'
+
+            segments.append((upper, points))
+            x, y = points[-1]
+            control = points[-2] if len(points) > 1 else None
+            if upper == 'M':
+                start = (x, y)
+
+        return segments
+
+    def transform_paths(self, paths):
+        """Transforms and rounds the coordinates of all collected paths and
+        writes their path data"""
+
+        if not paths:
+            return
+
+        points = []
+        matrices = []
+        for element, segments, matrix in paths:
+            for command, segment_points in segments:
+                points.extend(segment_points)
+                matrices.extend([matrix] * len(segment_points))
+
+        if numpy is not None and points:
+            pts = numpy.array(points, dtype=float)
+            mat = numpy.array(matrices, dtype=float)
+            xs = mat[:, 0, 0] * pts[:, 0] + mat[:, 0, 1] * pts[:, 1] + \
+                mat[:, 0, 2]
+            ys = mat[:, 1, 0] * pts[:, 0] + mat[:, 1, 1] * pts[:, 1] + \
+                mat[:, 1, 2]
+            coords = numpy.round(numpy.column_stack((xs, ys)),
+                                 self.precision).tolist()
+        else:
+            coords = [
+                [self.round(m[0][0] * px + m[0][1] * py + m[0][2]),
+                 self.round(m[1][0] * px + m[1][1] * py + m[1][2])]
+                for (px, py), m in zip(points, matrices)
+            ]
+
+        i = 0
+        for element, segments, matrix in paths:
+            parts = []
+            last = None
+            for command, segment_points in segments:
+                numbers = []
+                for j in range(len(segment_points)):
+                    numbers.extend(coords[i + j])
+                i += len(segment_points)
+
+                text = self.format_numbers(numbers)
+
+                # repeated commands may be omitted, except for movetos
+                if command != last or command == 'M':
+                    parts.append(command)
+                elif not text.startswith('-'):
+                    parts.append(' ')
+                parts.append(text)
+                last = command
+            element.attrib['d'] = ''.join(parts).strip()
+
+    def round(self, value):
+        return round(value, self.precision)
+
+    def format(self, value):
+        """Formats a number as short as possible"""
+
+        text = '%.*f' % (self.precision, value)
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if text in ('-0', ''):
+            text = '0'
+        return text
+
+    def format_numbers(self, values):
+        """Formats numbers separated by spaces, which are omitted before
+        negative numbers"""
+
+        text = ' '.join(self.format(v) for v in values)
+        return text.replace(' -', '-')
@@ -0,0 +1,85 @@
+import threading
+import Queue
+
+from converter import Converter
+
+
+def cpu_count():
+    """Returns the number of cores, or 1 if it can't be determined"""
+
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class RenderScheduler(object):
+    """
+    Renders several independent snippets concurrently. Every worker thread
+    runs its own Converter pipeline in its own temporary directory. As
+    latex and the converters are separate processes, the threads only wait
+    for them. The resulting svg groups are built afterwards in the calling
+    thread, because that touches the document.
+    """
+
+    def __init__(self, effect_class, workers=None, output_callback=None):
+        self.effect_class = effect_class
+        self.workers = int(workers) if workers else cpu_count()
+        self.output_callback = output_callback
+        self.renderers = []
+        self.cancelled = False
+
+    def run(self, srcs, settings, glyphs=None):
+        """Renders all sources and returns their svg groups in the same
+        order. Empty sources yield None, like in Converter.render_many. If
+        any of the renders failed, the first error is raised."""
+
+        jobs = Queue.Queue()
+        for i, src in enumerate(srcs):
+            if src.strip():
+                jobs.put((i, src))
+
+        svgs = [None] * len(srcs)
+        errors = []
+
+        def worker():
+            try:
+                with Converter(self.effect_class,
+                               self.output_callback) as renderer:
+                    self.renderers.append(renderer)
+                    if self.cancelled:
+                        renderer.cancel()
+
+                    while True:
+                        try:
+                            i, src = jobs.get_nowait()
+                        except Queue.Empty:
+                            return
+                        svgs[i] = renderer.produce(src, settings)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.workers, jobs.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        renderer = Converter(self.effect_class)
+        scale_factor = renderer.get_scale(settings)
+        minifier = renderer.get_minifier(settings)
+        return [renderer.get_svg_group(svg, scale_factor, glyphs, minifier)
+                if svg else None for svg in svgs]
+
+    def cancel(self):
+        """Cancel all running pipelines. This may be called from another
+        thread."""
+
+        self.cancelled = True
+        for renderer in self.renderers:
+            renderer.cancel()
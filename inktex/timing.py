@@ -0,0 +1,30 @@
+"""
+Startup measurements. If the environment variable INKTEX_PROFILE is set to
+a file name, the time since the start of the extension is appended to that
+file at some points of the startup, e.g. when all modules are imported and
+when the dialog has drawn its first frame:
+
+    INKTEX_PROFILE=/tmp/inktex-profile.txt inkscape drawing.svg
+"""
+
+import os
+import time
+
+# this module is imported first, so this is the start of the extension
+start_time = time.time()
+
+profile_file = os.environ.get('INKTEX_PROFILE')
+
+
+def mark(event):
+    """Records the time since the start, if profiling is enabled"""
+
+    if not profile_file:
+        return
+
+    try:
+        with open(profile_file, 'a') as f:
+            f.write("%d %s %.1f ms\n" % (os.getpid(), event,
+                                        (time.time() - start_time) * 1000))
+    except IOError:
+        pass
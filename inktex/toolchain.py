@@ -0,0 +1,180 @@
+import os
+import json
+import subprocess as sp
+
+from cache import cache_dir
+
+
+def find_executable(name):
+    """Looks up an executable in the PATH. Returns its full path or None."""
+
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def directory_mtimes():
+    """Returns the modification times of the directories in the PATH, which
+    change whenever an executable is installed in or removed from them.
+    Missing directories map to None."""
+
+    mtimes = {}
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        try:
+            mtimes[directory] = os.path.getmtime(directory)
+        except OSError:
+            mtimes[directory] = None
+    return mtimes
+
+
+def query_version(path):
+    """Runs the executable once with --version and returns the first line
+    of its output. Tools without a version switch yield an empty string."""
+
+    devnull = open(os.devnull, 'w')
+    try:
+        proc = sp.Popen([path, '--version'], stdout=sp.PIPE, stderr=devnull,
+                        stdin=sp.PIPE)
+        out, err = proc.communicate()
+    except OSError:
+        return ''
+    finally:
+        devnull.close()
+
+    if proc.returncode:
+        return ''
+    return out.strip().split('\n')[0]
+
+
+class Toolchain(object):
+    """
+    Finds the LaTeX compiler and svg converter to use. The result of the
+    discovery (paths, versions and the chosen pipeline) is stored in a state
+    file in the user cache, so subsequent renders don't have to start any
+    process to probe for the executables. The state is invalidated whenever
+    the PATH or the modification time of one of the executables or of the
+    directories in the PATH changes, e.g. because a preferred pipeline or an
+    optional tool was installed.
+    """
+
+    # pipelines in order of preference: (name, compiler, converter)
+    pipelines = [
+        ('dvi', 'latex', 'dvisvgm'),
+        ('pdf', 'pdflatex', 'pdf2svg'),
+    ]
+
+    # tools that are used if available, but are not required
+    optional = ['dvipng']
+
+    state_file = 'toolchain.json'
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path or \
+            os.path.join(cache_dir(), self.state_file)
+        self.state = None
+
+    def discover(self):
+        """Returns the toolchain state, probing the system only if the stored
+        state is missing or outdated."""
+
+        if self.state is None:
+            self.state = self.load()
+
+        if self.state is None:
+            self.state = self.probe()
+            self.save()
+
+        return self.state
+
+    def probe(self):
+        """Search the PATH for the first complete pipeline."""
+
+        state = {
+            'path': os.environ.get('PATH', ''),
+            'directories': directory_mtimes(),
+            'pipeline': None,
+            'executables': {},
+        }
+
+        for name, compiler, converter in self.pipelines:
+            executables = dict(
+                (tool, find_executable(tool)) for tool in (compiler, converter)
+            )
+            if None in executables.values():
+                continue
+
+            state['pipeline'] = name
+            for tool, path in executables.items():
+                state['executables'][tool] = {
+                    'path': path,
+                    'mtime': os.path.getmtime(path),
+                    'version': query_version(path),
+                }
+
+            for tool in self.optional:
+                path = find_executable(tool)
+                if path:
+                    state['executables'][tool] = {
+                        'path': path,
+                        'mtime': os.path.getmtime(path),
+                        'version': query_version(path),
+                    }
+            break
+
+        return state
+
+    def load(self):
+        """Reads the state file. Returns None if it doesn't exist or is
+        invalid."""
+
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        # a failed discovery is cheap to repeat, as no process is started
+        if state.get('pipeline') is None or \
+                state.get('path') != os.environ.get('PATH', '') or \
+                state.get('directories') != directory_mtimes():
+            return None
+
+        try:
+            for tool in state['executables'].values():
+                if os.path.getmtime(tool['path']) != tool['mtime']:
+                    return None
+        except (OSError, KeyError, TypeError):
+            return None
+
+        return state
+
+    def save(self):
+        """Writes the state file"""
+
+        try:
+            with open(self.state_path, 'w') as f:
+                json.dump(self.state, f)
+        except IOError:
+            pass
+
+    def get_pipeline(self):
+        """Returns the name of the chosen pipeline or None"""
+
+        return self.discover()['pipeline']
+
+    def has_tool(self, tool):
+        """Returns whether a tool, e.g. an optional one, was found"""
+
+        return tool in self.discover()['executables']
+
+    def get_path(self, tool):
+        """Returns the full path of a tool of the chosen pipeline"""
+
+        return self.discover()['executables'][tool]['path']
+
+    def get_version(self, tool):
+        """Returns the version string of a tool of the chosen pipeline"""
+
+        return self.discover()['executables'][tool]['version']
@@ -1,10 +1,17 @@
 import os
+import threading
 
 import pygtk
 pygtk.require('2.0')
 import gtk
+import gobject
+import pango
+
+# the rendering runs in a worker thread
+gobject.threads_init()
 
 from gtkcodebuffer import CodeBuffer, SyntaxLoader
+import timing
 
 
 class Ui(object):
@@ -22,20 +29,59 @@ The LaTeX code you write is only the stuff between <b>\begin{document}</b> and <
 
 The preamble file and scale factor are stored on a per-drawing basis, so in a new document, these information must be set again."""
 
+    # zoom factor of the preview image relative to the svg's size
+    preview_zoom = 2.0
+
     about_text = r"""Written by <a href="mailto:janoliver@oelerich.org">Jan Oliver Oelerich &lt;janoliver@oelerich.org&gt;</a>"""
 
-    def __init__(self, render_callback, src, settings):
+    def __init__(self, render_callback, src, settings,
+                 render_all_callback=None, render_selection_callback=None,
+                 render_outdated_callback=None, cancel_callback=None, preview_callback=None,
+                 cancel_preview_callback=None):
         """Takes the following parameters:
           * render_callback: callback function to execute with "apply" button
-          * src: source code that should be pre-inserted into the LaTeX input"""
+          * src: source code that should be pre-inserted into the LaTeX input
+          * settings: the settings stored in the document
+          * render_all_callback: callback function to re-render all objects
+            of the document with the current settings
+          * render_selection_callback: callback function to re-render the
+            selected objects with the current settings
+          * render_outdated_callback: callback function to re-render the
+            objects rendered with another preamble or toolchain
+          * cancel_callback: callback function to cancel a running render
+          * preview_callback: callback function returning an image (png or
+            svg file contents) of the given LaTeX code at the given
+            resolution, shown in the preview area
+          * cancel_preview_callback: callback function to cancel a running
+            preview render
+
+        The render callbacks are executed in a worker thread, so they must
+        not use GTK directly. log() and append_log() may be used, though."""
 
         self.render_callback = render_callback
+        self.render_all_callback = render_all_callback
+        self.render_selection_callback = render_selection_callback
+        self.render_outdated_callback = render_outdated_callback
+        self.cancel_callback = cancel_callback
+        self.worker = None
+        self.preview_callback = preview_callback
+        self.cancel_preview_callback = cancel_preview_callback
+        self.preview_worker = None
+        self.preview_timer = None
+        self.preview_pending = False
+        # counts the changes of the text, so previews of older text are
+        # recognized
+        self.preview_generation = 0
         self.src = src if src else ""
         self.settings = settings
 
-        # init the syntax highlighting buffer
-        lang = SyntaxLoader("latex")
-        self.syntax_buffer = CodeBuffer(lang=lang)
+        # the syntax highlighting buffer, the language is loaded once the
+        # window is shown
+        self.syntax_buffer = CodeBuffer()
+
+        # the tabs except for the first one are built when they are shown
+        # first, see build_page()
+        self.lazy_pages = {}
 
         self.setup_ui()
 
@@ -46,23 +92,240 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
         buf = self.text.get_buffer()
         tex = buf.get_text(buf.get_start_iter(), buf.get_end_iter())
 
+        self.run_async(self.render_callback, tex, self.get_settings())
+
+    def render_all(self, widget, data=None):
+        """Calls the render_all callback with the current settings and quits
+        on success."""
+
+        self.run_async(self.render_all_callback, self.get_settings())
+
+    def render_selection(self, widget, data=None):
+        """Calls the render_selection callback with the current settings and
+        quits on success."""
+
+        self.run_async(self.render_selection_callback, self.get_settings())
+
+    def render_outdated(self, widget, data=None):
+        """Calls the render_outdated callback with the current settings and
+        quits on success."""
+
+        self.run_async(self.render_outdated_callback, self.get_settings())
+
+    def run_async(self, callback, *args):
+        """Runs a render callback in a worker thread, so the dialog stays
+        responsive while latex is running. If the callback returns true,
+        we quit."""
+
+        if self.worker is not None:
+            return
+
+        self.build_page(self.page_log)
+        self.log_view.get_buffer().set_text("")
+        self.set_busy(True)
+
+        def work():
+            result = False
+            try:
+                result = callback(*args)
+            finally:
+                gobject.idle_add(self.render_done, result)
+
+        self.worker = threading.Thread(target=work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def render_done(self, result):
+        """Called in the GTK loop, when the worker thread finished"""
+
+        self.worker = None
+        self.set_busy(False)
+
+        if result:
+            gtk.main_quit()
+        return False
+
+    def set_busy(self, busy):
+        """Switch between the idle state and the rendering state, in which
+        the progress bar and the stop button are shown."""
+
+        self.button_render.set_sensitive(not busy)
+        self.settings_container.set_sensitive(not busy)
+
+        if busy:
+            self.progress.show()
+            self.button_stop.show()
+            gobject.timeout_add(100, self.pulse)
+        else:
+            self.progress.hide()
+            self.button_stop.hide()
+
+    def pulse(self):
+        """Animate the progress bar while rendering"""
+
+        if self.worker is None:
+            return False
+
+        self.progress.pulse()
+        return True
+
+    def stop(self, widget, data=None):
+        """Stop button pressed: kill the running compiler/converter"""
+
+        if self.cancel_callback and self.worker is not None:
+            self.cancel_callback()
+
+    def schedule_preview(self, widget=None, data=None):
+        """The LaTeX code changed: (re)start the timer for the preview. The
+        preview is rendered, once the user stopped typing for the configured
+        delay. A preview that is still rendering is outdated from now on."""
+
+        if not self.preview_callback:
+            return
+
+        self.preview_generation += 1
+
+        if self.preview_timer is not None:
+            gobject.source_remove(self.preview_timer)
+            self.preview_timer = None
+
+        self.build_page(self.page_settings)
+        delay = int(self.preview_delay.get_value())
+        if delay > 0:
+            self.preview_timer = gobject.timeout_add(delay, self.start_preview)
+
+    def start_preview(self):
+        """Render the preview of the current LaTeX code in a worker thread.
+        If a preview is still rendering, it is cancelled and the new one is
+        started once it terminated, so there is at most one preview render
+        at a time and only the latest text is rendered."""
+
+        self.preview_timer = None
+
+        if self.preview_worker is not None:
+            self.preview_pending = True
+            if self.cancel_preview_callback:
+                self.cancel_preview_callback()
+            return False
+
+        self.preview_pending = False
+
+        buf = self.text.get_buffer()
+        tex = buf.get_text(buf.get_start_iter(), buf.get_end_iter())
+        if not tex.strip():
+            self.preview_image.clear()
+            return False
+
+        settings = self.get_settings()
+        dpi = self.get_preview_dpi()
+        generation = self.preview_generation
+
+        def work():
+            result, error = None, None
+            try:
+                result = self.preview_callback(tex, settings, dpi)
+            except Exception, e:
+                error = e
+            gobject.idle_add(self.preview_done, result, error, generation)
+
+        self.preview_label.set_text("Rendering preview...")
+        self.preview_worker = threading.Thread(target=work)
+        self.preview_worker.daemon = True
+        self.preview_worker.start()
+        return False
+
+    def preview_done(self, image, error, generation):
+        """Called in the GTK loop, when the preview worker finished. Results
+        of renders, that were superseded by newer text, are dropped."""
+
+        self.preview_worker = None
+
+        if self.preview_pending:
+            self.start_preview()
+        elif generation != self.preview_generation:
+            # the timer for the newer text is still running
+            pass
+        elif error is not None:
+            self.preview_label.set_text(str(error).strip().split("\n")[0])
+        elif image is not None:
+            self.show_preview(image)
+
+        return False
+
+    def get_preview_dpi(self):
+        """Returns the resolution for raster previews, i.e. the screen
+        resolution times the zoom factor"""
+
+        dpi = gtk.gdk.screen_get_default().get_resolution()
+        if dpi <= 0:
+            dpi = 96.0
+        return dpi * self.preview_zoom
+
+    def show_preview(self, image):
+        """Display the image data (png or svg) in the preview area"""
+
+        def zoom(loader, width, height):
+            loader.set_size(int(width * self.preview_zoom),
+                            int(height * self.preview_zoom))
+
+        try:
+            loader = gtk.gdk.PixbufLoader()
+            # png previews are rendered at the right resolution already
+            if not image.startswith('\x89PNG'):
+                loader.connect("size-prepared", zoom)
+            loader.write(image)
+            loader.close()
+        except gobject.GError, e:
+            self.preview_label.set_text("Preview not available: %s" % e)
+            return
+
+        self.preview_image.set_from_pixbuf(loader.get_pixbuf())
+        self.preview_label.set_text("")
+
+    def stop_preview(self):
+        """Cancel pending and running preview renders"""
+
+        if self.preview_timer is not None:
+            gobject.source_remove(self.preview_timer)
+            self.preview_timer = None
+
+        if self.preview_worker is not None and self.cancel_preview_callback:
+            self.cancel_preview_callback()
+
+    def get_settings(self):
+        """Returns a dict of the settings entered in the settings tab"""
+
+        self.build_page(self.page_settings)
+
         settings = dict()
         if self.preamble.get_filename():
             settings['preamble'] = self.preamble.get_filename()
         settings['scale'] = self.scale.get_value()
+        settings['timeout'] = self.timeout.get_value()
+        settings['preview_delay'] = int(self.preview_delay.get_value())
+        settings['share_glyphs'] = self.share_glyphs.get_active()
+        settings['clone_identical'] = self.clone_identical.get_active()
+        settings['minify'] = self.minify.get_active()
+        settings['precision'] = int(self.precision.get_value())
 
-        if self.render_callback(tex, settings):
-            gtk.main_quit()
-            return False
+        return settings
 
     def cancel(self, widget, data=None):
         """Close button pressed: Exit"""
 
+        self.stop(widget)
+        self.stop_preview()
         raise SystemExit(1)
 
     def destroy(self, widget, event, data=None):
-        """Destroy hook for the GTK window. Quit and return False."""
-
+        """Destroy hook for the GTK window. Quit and return False. A running
+        render is cancelled and waited for, since it changes the document,
+        which is written once we quit."""
+
+        self.stop(widget)
+        self.stop_preview()
+        if self.worker is not None:
+            self.worker.join()
         gtk.main_quit()
         return False
 
@@ -100,12 +363,18 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
         self.notebook.append_page(self.page_log, gtk.Label("Log"))
         self.notebook.append_page(self.page_settings, gtk.Label("Settings"))
         self.notebook.append_page(self.page_help, gtk.Label("Help"))
+        self.notebook.connect("switch-page", self.switch_page)
         self.notebook.show()
 
+        self.lazy_pages[self.page_log] = self.setup_log
+        self.lazy_pages[self.page_settings] = self.setup_settings
+        self.lazy_pages[self.page_help] = self.setup_help
+
         # First component: The input text view for the LaTeX code.
         # It lives in a ScrolledWindow so we can get some scrollbars when the
         # text is too long.
         self.text = gtk.TextView(self.syntax_buffer)
+        self.syntax_buffer.add_view(self.text)
         self.text.get_buffer().set_text(self.src)
         self.text.show()
         self.text_container = gtk.ScrolledWindow()
@@ -118,8 +387,108 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
 
         self.page_latex.pack_start(self.text_container)
 
+        # the preview of the LaTeX code, updated while typing
+        if self.preview_callback:
+            self.preview_image = gtk.Image()
+            self.preview_image.show()
+            self.preview_label = gtk.Label()
+            self.preview_label.set_alignment(0, 0.5)
+            self.preview_label.set_ellipsize(pango.ELLIPSIZE_END)
+            self.preview_label.show()
+
+            self.preview_viewport = gtk.ScrolledWindow()
+            self.preview_viewport.set_policy(gtk.POLICY_AUTOMATIC,
+                                             gtk.POLICY_AUTOMATIC)
+            self.preview_viewport.set_shadow_type(gtk.SHADOW_IN)
+            self.preview_viewport.add_with_viewport(self.preview_image)
+            self.preview_viewport.set_size_request(300, 200)
+            self.preview_viewport.show()
+
+            self.preview_container = gtk.VBox(False, 5)
+            self.preview_container.pack_start(self.preview_viewport)
+            self.preview_container.pack_start(self.preview_label, False, False)
+            self.preview_container.show()
+
+            self.page_latex.pack_start(self.preview_container)
+
+            self.text.get_buffer().connect("changed", self.schedule_preview)
+
+        self.box_container.pack_start(self.notebook, True, True)
+
+        # separator between buttonbar and notebook
+        self.separator_buttons = gtk.HSeparator()
+        self.separator_buttons.show()
+
+        self.box_container.pack_start(self.separator_buttons, False, False)
+
+        # the button bar with the progress bar, shown while rendering
+        self.box_bottom = gtk.HBox(False, 5)
+        self.box_bottom.show()
+
+        self.progress = gtk.ProgressBar()
+        self.progress.set_text("Rendering...")
+
+        self.box_buttons = gtk.HButtonBox()
+        self.box_buttons.set_layout(gtk.BUTTONBOX_END)
+        self.box_buttons.show()
+
+        self.button_render = gtk.Button(stock=gtk.STOCK_APPLY)
+        self.button_stop = gtk.Button(stock=gtk.STOCK_STOP)
+        self.button_cancel = gtk.Button(stock=gtk.STOCK_CLOSE)
+        self.button_render.set_flags(gtk.CAN_DEFAULT)
+        self.button_render.connect("clicked", self.render, None)
+        self.button_stop.connect("clicked", self.stop, None)
+        self.button_cancel.connect("clicked", self.cancel, None)
+        self.button_render.show()
+        self.button_cancel.show()
+
+        self.box_buttons.pack_end(self.button_cancel)
+        self.box_buttons.pack_end(self.button_stop)
+        self.box_buttons.pack_end(self.button_render)
+
+        self.box_bottom.pack_start(self.progress, False, False)
+        self.box_bottom.pack_end(self.box_buttons, False, False)
+
+        self.box_container.pack_start(self.box_bottom, False, False)
+
+        self.window.add(self.box_container)
+        self.window.set_default(self.button_render)
+        self.map_handler = self.window.connect("map-event", self.mapped)
+        self.window.show()
+
+    def mapped(self, widget, event, data=None):
+        """The window was mapped: everything not needed for the first frame
+        is done once it is drawn."""
+
+        self.window.disconnect(self.map_handler)
+        gobject.idle_add(self.setup_deferred)
+        return False
+
+    def setup_deferred(self):
+        """Loads the syntax highlighting and starts the initial preview of
+        the edited object, after the window was drawn."""
+
+        timing.mark('first frame')
+
+        self.syntax_buffer.reset_language(SyntaxLoader("latex"))
+
+        if self.src:
+            self.schedule_preview()
+        return False
+
+    def switch_page(self, notebook, page, page_num):
+        self.build_page(notebook.get_nth_page(page_num))
+
+    def build_page(self, page):
+        """Builds the contents of a tab, unless that happened already"""
+
+        setup = self.lazy_pages.pop(page, None)
+        if setup is not None:
+            setup()
+
+    def setup_log(self):
+        """Creates the log tab"""
 
-        # Second component: The log view
         self.log_view = gtk.TextView()
         self.log_view.show()
         self.log_container = gtk.ScrolledWindow()
@@ -132,9 +501,10 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
 
         self.page_log.pack_start(self.log_container)
 
+    def setup_settings(self):
+        """Creates the settings tab"""
 
-        # third component: settings
-        self.settings_container = gtk.Table(2,2)
+        self.settings_container = gtk.Table(10,2)
         self.settings_container.set_row_spacings(8)
         self.settings_container.show()
 
@@ -165,10 +535,102 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
         self.settings_container.attach(self.scale, yoptions=gtk.SHRINK,
             left_attach=1, right_attach=2, top_attach=1, bottom_attach=2)
 
+        self.label_timeout = gtk.Label("Timeout (seconds, 0 = none)")
+        self.label_timeout.set_alignment(0, 0.5)
+        self.label_timeout.show()
+        self.timeout_adjustment = gtk.Adjustment(value=60, lower=0,
+                                                 upper=3600, step_incr=1)
+        self.timeout = gtk.SpinButton(adjustment=self.timeout_adjustment)
+        if 'timeout' in self.settings:
+            self.timeout.set_value(float(self.settings['timeout']))
+        self.timeout.show()
+        self.settings_container.attach(self.label_timeout, yoptions=gtk.SHRINK,
+            left_attach=0, right_attach=1, top_attach=2, bottom_attach=3)
+        self.settings_container.attach(self.timeout, yoptions=gtk.SHRINK,
+            left_attach=1, right_attach=2, top_attach=2, bottom_attach=3)
+
+        self.label_preview_delay = gtk.Label("Preview delay (ms, 0 = off)")
+        self.label_preview_delay.set_alignment(0, 0.5)
+        self.label_preview_delay.show()
+        self.preview_delay_adjustment = gtk.Adjustment(value=500, lower=0,
+                                                       upper=10000,
+                                                       step_incr=100)
+        self.preview_delay = gtk.SpinButton(
+            adjustment=self.preview_delay_adjustment)
+        if 'preview_delay' in self.settings:
+            self.preview_delay.set_value(float(self.settings['preview_delay']))
+        self.preview_delay.show()
+        self.settings_container.attach(self.label_preview_delay,
+            yoptions=gtk.SHRINK,
+            left_attach=0, right_attach=1, top_attach=3, bottom_attach=4)
+        self.settings_container.attach(self.preview_delay, yoptions=gtk.SHRINK,
+            left_attach=1, right_attach=2, top_attach=3, bottom_attach=4)
+
+        self.share_glyphs = gtk.CheckButton(
+            "Share glyphs between objects (smaller files)")
+        self.share_glyphs.set_active(
+            str(self.settings.get('share_glyphs', False)) == 'True')
+        self.share_glyphs.show()
+        self.settings_container.attach(self.share_glyphs, yoptions=gtk.SHRINK,
+            left_attach=1, right_attach=2, top_attach=4, bottom_attach=5)
+
+        self.clone_identical = gtk.CheckButton(
+            "Insert identical objects as clones")
+        self.clone_identical.set_active(
+            str(self.settings.get('clone_identical', False)) == 'True')
+        self.clone_identical.show()
+        self.settings_container.attach(self.clone_identical,
+            yoptions=gtk.SHRINK,
+            left_attach=1, right_attach=2, top_attach=5, bottom_attach=6)
+
+        self.minify = gtk.CheckButton("Minify, with decimal places:")
+        self.minify.set_active(
+            str(self.settings.get('minify', False)) == 'True')
+        self.minify.show()
+        self.precision_adjustment = gtk.Adjustment(value=3, lower=0, upper=8,
+                                                   step_incr=1)
+        self.precision = gtk.SpinButton(adjustment=self.precision_adjustment)
+        if 'precision' in self.settings:
+            self.precision.set_value(float(self.settings['precision']))
+        self.precision.show()
+        self.box_minify = gtk.HBox(False, 5)
+        self.box_minify.pack_start(self.minify, False, False)
+        self.box_minify.pack_start(self.precision, False, False)
+        self.box_minify.show()
+        self.settings_container.attach(self.box_minify, yoptions=gtk.SHRINK,
+            left_attach=1, right_attach=2, top_attach=6, bottom_attach=7)
+
+        if self.render_all_callback:
+            self.button_render_all = gtk.Button("Re-render all objects")
+            self.button_render_all.connect("clicked", self.render_all, None)
+            self.button_render_all.show()
+            self.settings_container.attach(self.button_render_all,
+                yoptions=gtk.SHRINK, xoptions=gtk.SHRINK,
+                left_attach=1, right_attach=2, top_attach=7, bottom_attach=8)
+
+        if self.render_outdated_callback:
+            self.button_render_outdated = gtk.Button("Update outdated objects")
+            self.button_render_outdated.connect("clicked",
+                self.render_outdated, None)
+            self.button_render_outdated.show()
+            self.settings_container.attach(self.button_render_outdated,
+                yoptions=gtk.SHRINK, xoptions=gtk.SHRINK,
+                left_attach=1, right_attach=2, top_attach=8, bottom_attach=9)
+
+        if self.render_selection_callback:
+            self.button_render_selection = gtk.Button("Re-render selection")
+            self.button_render_selection.connect("clicked",
+                self.render_selection, None)
+            self.button_render_selection.show()
+            self.settings_container.attach(self.button_render_selection,
+                yoptions=gtk.SHRINK, xoptions=gtk.SHRINK,
+                left_attach=1, right_attach=2, top_attach=9, bottom_attach=10)
+
         self.page_settings.pack_start(self.settings_container)
 
+    def setup_help(self):
+        """Creates the help tab"""
 
-        # help tab
         self.help_label = gtk.Label()
         self.help_label.set_markup(Ui.help_text)
         self.help_label.set_line_wrap(True)
@@ -186,41 +648,30 @@ The preamble file and scale factor are stored on a per-drawing basis, so in a ne
         self.page_help.pack_start(self.separator_help)
         self.page_help.pack_start(self.about_label)
 
+    def log(self, msg):
+        """Show a message in the log tab. May be called from any thread."""
 
-        self.box_container.pack_start(self.notebook, True, True)
-
-        # separator between buttonbar and notebook
-        self.separator_buttons = gtk.HSeparator()
-        self.separator_buttons.show()
-
-        self.box_container.pack_start(self.separator_buttons, False, False)
-
-        # the button bar
-        self.box_buttons = gtk.HButtonBox()
-        self.box_buttons.set_layout(gtk.BUTTONBOX_END)
-        self.box_buttons.show()
-
-        self.button_render = gtk.Button(stock=gtk.STOCK_APPLY)
-        self.button_cancel = gtk.Button(stock=gtk.STOCK_CLOSE)
-        self.button_render.set_flags(gtk.CAN_DEFAULT)
-        self.button_render.connect("clicked", self.render, None)
-        self.button_cancel.connect("clicked", self.cancel, None)
-        self.button_render.show()
-        self.button_cancel.show()
+        gobject.idle_add(self.show_log, msg)
 
-        self.box_buttons.pack_end(self.button_cancel)
-        self.box_buttons.pack_end(self.button_render)
+    def show_log(self, msg):
+        self.build_page(self.page_log)
+        buffer = self.log_view.get_buffer()
+        buffer.set_text(msg)
+        self.notebook.set_current_page(1)
+        return False
 
-        self.box_container.pack_start(self.box_buttons, False, False)
+    def append_log(self, text):
+        """Append compiler output to the log tab as it arrives. May be
+        called from any thread."""
 
-        self.window.add(self.box_container)
-        self.window.set_default(self.button_render)
-        self.window.show()
+        gobject.idle_add(self.insert_log, text)
 
-    def log(self, msg):
+    def insert_log(self, text):
+        self.build_page(self.page_log)
         buffer = self.log_view.get_buffer()
-        buffer.set_text(msg)
-        self.notebook.set_current_page(1)
+        buffer.insert(buffer.get_end_iter(), text)
+        self.log_view.scroll_to_mark(buffer.get_insert(), 0)
+        return False
 
     def main(self):
         gtk.main()
@@ -0,0 +1,148 @@
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+
+from cache import makedirs, runtime_dir, scratch_dir, directory_entries
+
+
+def workspace_root():
+    """Returns (and creates) the directory containing the workspaces. It is
+    on a RAM backed filesystem, if one is available."""
+
+    return makedirs(os.path.join(scratch_dir() or runtime_dir(),
+                                 'workspaces'), 0700)
+
+
+class Workspace(object):
+    """
+    A persistent working directory for the latex runs with one preamble.
+    Unlike a temporary directory, it survives between renders, so the .aux
+    file and other state of earlier runs is available to later ones.
+
+    A workspace is locked with flock while it is used. If the workspace is
+    locked by another Inkscape instance or render thread, the next slot
+    with the same name is used. When a workspace is released, workspaces
+    not used for max_age seconds are removed, as well as the least recently
+    used ones while all of them together are larger than max_size bytes.
+    """
+
+    lock_file = '.lock'
+    trash_prefix = '.trash-'
+
+    # the number of workspaces with the same name used at the same time
+    max_slots = 16
+
+    def __init__(self, name, root=None, max_age=24 * 3600,
+                 max_size=50 * 1024 * 1024):
+        self.name = name
+        self.root = root
+        self.max_age = max_age
+        self.max_size = max_size
+
+        self.path = None
+        self.lock = None
+
+    def acquire(self):
+        """Lock the first free slot and return its path. Returns None, if no
+        workspace could be locked."""
+
+        try:
+            self.root = self.root or workspace_root()
+        except OSError:
+            return None
+
+        for slot in range(self.max_slots):
+            path = os.path.join(self.root, '%s-%d' % (self.name, slot))
+            lock = self.try_lock(path)
+            if lock is not None:
+                # the modification time tells the cleanup when it was used
+                os.utime(path, None)
+                self.path, self.lock = path, lock
+                return path
+
+        return None
+
+    def release(self):
+        """Unlock the workspace and clean up old ones"""
+
+        if self.lock is None:
+            return
+
+        os.close(self.lock)
+        self.path = self.lock = None
+
+        self.cleanup()
+
+    def try_lock(self, path):
+        """Returns the file descriptor of the locked lock file of a
+        workspace, or None if it is locked already"""
+
+        lock_path = os.path.join(path, self.lock_file)
+        try:
+            makedirs(path, 0700)
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        except OSError:
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # a cleanup may have removed the workspace before we got the lock
+            if os.fstat(fd).st_ino != os.stat(lock_path).st_ino:
+                raise OSError("Workspace was removed")
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+
+        return fd
+
+    def cleanup(self):
+        """Remove workspaces, which were not used for max_age seconds, and
+        the least recently used ones, while all of them together are larger
+        than max_size. Workspaces in use are never removed."""
+
+        now = time.time()
+        workspaces = []
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(self.trash_prefix):
+                # left over by an interrupted cleanup
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            size = sum(e[1] for e in directory_entries(path))
+            workspaces.append((mtime, size, path))
+
+        workspaces.sort()
+        size = sum(w[1] for w in workspaces)
+
+        for mtime, workspace_size, path in workspaces:
+            if now - mtime < self.max_age and size <= self.max_size:
+                break
+            if self.remove(path):
+                size -= workspace_size
+
+    def remove(self, path):
+        """Remove a workspace, unless it is locked. Returns whether it was
+        removed."""
+
+        lock = self.try_lock(path)
+        if lock is None:
+            return False
+
+        try:
+            # move it out of the way first, so nobody locks it meanwhile
+            trash = tempfile.mkdtemp(dir=self.root, prefix=self.trash_prefix)
+            os.rename(path, os.path.join(trash, 'workspace'))
+            shutil.rmtree(trash, ignore_errors=True)
+        except OSError:
+            return False
+        finally:
+            os.close(lock)
+
+        return True